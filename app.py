@@ -1,35 +1,56 @@
 import os
 import sys
+import hmac
 import json
-import searchengine
-from nltk.stem import porter
-import crawler
-import neuralnet
+import threading
 import requests
+import sessions
 from flask import Flask, request
 
 app = Flask(__name__)
 
 domain = 'https://techfugees/'
-search = searchengine.Searcher('searchindex.db')
+search = None  # searchengine.Searcher, created by warm_up
 
 score_idx = 0
 url_idx = 1
-
-stemmer = porter.PorterStemmer()
-
-food_list = [stemmer.stem(w) for w in ['hungry', 'food', 'eat', 'drink', 'water', 'kebab', 'thirsty']]
-med_list = [stemmer.stem(w) for w in
-            ['doctor', 'hospital', 'ambulance', 'prescription', 'asthma', 'bronchitis', 'cancer', 'disorder',
-             'insulin', 'diabetes', 'pain', 'hurt', 'vomit', 'aid', 'ache', 'cough', 'seizure', 'labour',
-             'headache', 'weak', 'numb', 'pregnant', 'medical', 'drugs']]
-azil_list = [stemmer.stem(w) for w in ['home', 'bed', 'sleep', 'asylum', 'shower', 'nursery', 'shelter']]
-legal_list = [stemmer.stem(w) for w in ['papers', 'law', 'process']]
-educ_list = [stemmer.stem(w) for w in ['education']]
-nonfood_list = [stemmer.stem(w) for w in ['education']]
-transp_list = [stemmer.stem(w) for w in ['transport']]
-work_list = [stemmer.stem(w) for w in ['work']]
-children_list = [stemmer.stem(w) for w in ['children']]
+snippet_idx = 2
+
+MESSAGE_LIMIT = 2000  # Maximum length of Messenger text message
+BATCH_LIMIT = 100  # Maximum number of queries in one /search/batch request
+WARM_UP_TIMEOUT = 20  # Seconds a message waits for warm up before Messenger is asked to retry
+# 'background' answers health checks right away and warms up in a thread, 'eager' warms up on import
+STARTUP_MODE = os.environ.get('STARTUP_MODE', 'background')
+
+ready = threading.Event()
+warm_up_errors = []
+
+RESULTS_TTL = 5 * 60  # Seconds results of a query are reused for anyone asking the same
+MAX_CACHED_QUERIES = 10000
+conversations = sessions.TTLCache(sessions.SESSION_TTL, sessions.MAX_SESSIONS)  # {sender_id: Session}
+recent_results = sessions.TTLCache(RESULTS_TTL, MAX_CACHED_QUERIES)  # {query key: results}
+flight = sessions.SingleFlight()
+more_messages = set(['more', 'next', 'more please', 'show more'])
+more_hint = "Write 'more' for more websites."
+
+food_list = ['hungry', 'food', 'eat', 'drink', 'water', 'kebab', 'thirsty']
+med_list = ['doctor', 'hospital', 'ambulance', 'prescription', 'asthma', 'bronchitis', 'cancer', 'disorder',
+            'insulin', 'diabetes', 'pain', 'hurt', 'vomit', 'aid', 'ache', 'cough', 'seizure', 'labour',
+            'headache', 'weak', 'numb', 'pregnant', 'medical', 'drugs']
+azil_list = ['home', 'bed', 'sleep', 'asylum', 'shower', 'nursery', 'shelter']
+legal_list = ['papers', 'law', 'process']
+educ_list = ['education']
+nonfood_list = ['education']
+transp_list = ['transport']
+work_list = ['work']
+children_list = ['children']
+
+# guide.me categories and their words, stemmed by warm_up
+category_words = [
+    ('1', med_list), ('2', legal_list), ('3', food_list), ('4', educ_list), ('5', nonfood_list),
+    ('6', transp_list), ('7', azil_list), ('8', work_list), ('9', children_list),
+]
+category_stems = []
 
 
 @app.route('/', methods=['GET'])
@@ -44,10 +65,23 @@ def verify():
     return "Hello world", 200
 
 
+@app.route('/health', methods=['GET'])
+def health():
+    # readiness probe, the app answers messages once warm up is done
+    if ready.is_set():
+        return "ready", 200
+    if warm_up_errors:
+        return "warm up failed: " + warm_up_errors[-1], 503
+    return "warming up", 503
+
+
 @app.route('/', methods=['POST'])
 def webhook():
     # endpoint for processing incoming messaging events
 
+    if not wait_ready():
+        return "warming up", 503
+
     data = request.get_json()
     log(data)  # you may not want to log every incoming message in production, but it's good for testing
 
@@ -64,9 +98,10 @@ def webhook():
                     message_text = messaging_event["message"]["text"]  # the message's text
 
                     msage = guidme_responder(message_text)
-                    send_message(msage)
+                    if msage is not None:
+                        send_message(sender_id, msage)
 
-                    msg = responder(message_text)
+                    msg = conversation_responder(sender_id, message_text)
                     send_message(sender_id, msg)
 
                 if messaging_event.get("delivery"):  # delivery confirmation
@@ -81,6 +116,50 @@ def webhook():
     return "ok", 200
 
 
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    # ranked results for many queries, e.g. {"queries": ["shelter", ...], "partial": true}
+    # for offline evaluation only, callers send "Authorization: Bearer <BATCH_TOKEN>"
+    if not batch_authorized():
+        return "Batch token mismatch", 403
+    data = request.get_json(silent=True) or {}
+    queries = data.get("queries")
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+        return "queries must be a list of strings", 400
+    if len(queries) > BATCH_LIMIT:
+        return "at most %d queries per batch" % BATCH_LIMIT, 413
+    if not wait_ready():
+        return "warming up", 503
+
+    results = search.query_many(queries, partial=bool(data.get("partial", False)))
+    return json.dumps({
+        "results": [[{"score": score, "url": url} for (score, url) in result] for result in results]
+    }), 200, {"Content-Type": "application/json"}
+
+
+def batch_authorized():
+    # batch search is disabled unless BATCH_TOKEN is set
+    token = os.environ.get("BATCH_TOKEN")
+    if not token:
+        return False
+    expected = "Bearer " + token
+    return hmac.compare_digest(request.headers.get("Authorization", "").encode('utf-8'), expected.encode('utf-8'))
+
+
+@app.teardown_appcontext
+def close_connections(exception):
+    # every request runs in its own thread, its index connections end with it
+    if search is not None:
+        search.close_thread()
+
+
+def wait_ready():
+    # waits for warm up, without waiting if it has already failed
+    if warm_up_errors:
+        return False
+    return ready.wait(WARM_UP_TIMEOUT)
+
+
 def send_message(recipient_id, message_text):
     log("sending message to {recipient}: {text}".format(recipient=recipient_id, text=message_text))
 
@@ -110,57 +189,138 @@ def log(message):  # simple wrapper for logging to stdout on heroku
 
 
 def guidme_responder(message):
-    query_words = message.split(' ')
+    # links to guide.me categories of the message words, None if there are none
+    if message.strip().lower() in more_messages:
+        return None
+    query_words = search.stem_words(message.lower())
     urls = []
     categories = 'categories/'
     for word in query_words:
+        for (category, stems) in category_stems:
+            if word in stems:
+                urls.append(domain + categories + category)
 
-        if word in med_list:
-            urls.append(domain + categories + '1')
-        if word in legal_list:
-            urls.append(domain + categories + '2')
-        if word in food_list:
-            urls.append(domain + categories + '3')
-        if word in educ_list:
-            urls.append(domain + categories + '4')
-        if word in nonfood_list:
-            urls.append(domain + categories + '5')
-        if word in transp_list:
-            urls.append(domain + categories + '6')
-        if word in azil_list:
-            urls.append(domain + categories + '7')
-        if word in work_list:
-            urls.append(domain + categories + '8')
-        if word in children_list:
-            urls.append(domain + categories + '9')
-
-    resp_message = "I'm sure these informations from our website will be quite usefull."
+    if not urls:
+        return None
+    resp_message = "I'm sure these informations from our website will be quite usefull.\n"
     resp_message += '\n'.join(urls)
     return resp_message
 
 
 def responder(message):
-    response = search.query(message)
+    resp_message, cursor = format_results(search_results(message)[1])
+    return resp_message
+
+
+def conversation_responder(sender_id, message):
+    # replies using what we remember about the conversation, "more" continues the last answer
+    session = conversations.get(sender_id)
+    if message.strip().lower() in more_messages:
+        if session is None:
+            return "Ask me a question first and I'll look for websites that could help."
+        if session.cursor >= len(session.results):
+            return "That's all I found, try asking in other words."
+        resp_message, session.cursor = format_results(session.results, session.cursor)
+        return resp_message
+
+    key = query_key(message)
+    if session is not None and session.key == key:
+        results = session.results  # repeated question
+    else:
+        key, results = search_results(message)
+    resp_message, cursor = format_results(results)
+    conversations.put(sender_id, sessions.Session(key, results, cursor))
+    return resp_message
+
+
+def query_key(message):
+    # messages with the same stems get the same answer
+    return tuple(search.stem_words(message))
+
+
+def search_results(message):
+    """
+    Ranked results with snippets for the message. Results of recent messages
+    are served from memory and identical searches in flight run only once.
+
+    :param message: message text
+    :return: tuple (query key, results of Searcher.query_with_snippets)
+    """
+    key = query_key(message)
+    results = recent_results.get(key)
+    if results is None:
+        results = flight.do(key, lambda: search.query_with_snippets(message, partial=True))
+        recent_results.put(key, results)
+    return key, results
+
+
+def format_results(response, start=0):
+    """
+    Builds reply from ranked results starting at result start. The first reply
+    has results close to the best one, following replies whatever fits in a message.
+
+    :param response: results of Searcher.query_with_snippets
+    :param start: index of first result to send
+    :return: tuple (reply, index of first result not sent)
+    """
     resp_message = ''
     if response[0][score_idx] == -1.0:
         resp_message += "I'm not sure what you asked me, check if you made any typo. " \
                         "In any case check this website for additional information: "
         resp_message += response[0][url_idx]
-        return resp_message
+        return resp_message, len(response)
     else:
-        resp_message += "I belive this websites could help you, check it out."
+        if start == 0:
+            resp_message += "I belive this websites could help you, check it out."
+        else:
+            resp_message += "Here are more websites that could help you."
         max_score = response[0][score_idx]
         urls = []
-        for i in range(len(response)):
-            if max_score - response[i][score_idx] > 2:
+        i = start
+        while i < len(response):
+            if start == 0 and max_score - response[i][score_idx] > 2:
                 break
-            urls.append(response[i][url_idx])
-        resp_message += '\n'.join(urls)
-        return resp_message
+            url = response[i][url_idx]
+            if response[i][snippet_idx]:
+                url += '\n' + response[i][snippet_idx]
+            length = len(resp_message) + sum(len(u) + 1 for u in urls) + len(url) + 1 + len(more_hint) + 1
+            if urls and length > MESSAGE_LIMIT:
+                break
+            urls.append(url)
+            i += 1
+        resp_message += '\n' + '\n'.join(urls)
+        if i < len(response):
+            resp_message += '\n' + more_hint
+        return resp_message, i
+
+
+def warm_up():
+    """
+    Imports search engine and preloads its serving structures. Crawler,
+    gensim and neural net training are not imported, only starter needs them.
+    """
+    global search, category_stems
+    try:
+        import searchengine
+        from nltk.stem import porter
+        stemmer = porter.PorterStemmer()
+        category_stems = [(category, [stemmer.stem(w) for w in words]) for (category, words) in category_words]
+        searcher = searchengine.Searcher('searchindex.db')
+        searcher.warm_up()
+        searcher.close_thread()
+        search = searcher
+        ready.set()
+        log('warm up finished')
+    except Exception as e:
+        warm_up_errors.append(str(e))
+        log('warm up failed: %s' % e)
 
 
 # Pri inicijalizaciji postavka baze i crawlovanje
 def starter():
+    import crawler
+    import neuralnet
+    import topicmodel
     c = crawler.Crawler('searchindex.db')
     try:
         c.create_index_tables()
@@ -172,6 +332,13 @@ def starter():
     except Exception:
         pass
     c.crawl()
+    topicmodel.build_topic_index('searchindex.db')
+
+
+if STARTUP_MODE == 'eager':
+    warm_up()
+else:
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,72 @@
+"""
+Cold start benchmark of the Flask app. Every run starts a fresh interpreter
+and measures time to import app.py and time until warm up is finished.
+
+    python bench_startup.py [runs]
+"""
+import os
+import re
+import subprocess
+import sys
+
+PROBE = '''
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.ready.wait(300)
+print('startup %f %f' % (imported - start, time.perf_counter() - start), flush=True)
+'''
+
+
+def measure(mode, runs):
+    """
+    Runs the app import in fresh interpreters.
+
+    :param mode: STARTUP_MODE of the app
+    :param runs: number of interpreters
+    :return: list of tuples (import seconds, ready seconds)
+    """
+    env = dict(os.environ, STARTUP_MODE=mode)
+    results = []
+    for i in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', PROBE], env=env, universal_newlines=True)
+        # App logs from the warm up thread may share the line
+        imported, ready = re.search('startup ([0-9.]+) ([0-9.]+)', out).groups()
+        results.append((float(imported), float(ready)))
+    return results
+
+
+def import_profile(top=10):
+    """
+    Returns modules imported directly by the app (warm up included) with
+    largest cumulative import time, from python -X importtime.
+
+    :param top: number of modules
+    :return: list of tuples (cumulative microseconds, module name)
+    """
+    env = dict(os.environ, STARTUP_MODE='eager')
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        if level == 1:
+            modules.append((int(cumulative), name.strip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for mode in ('background', 'eager'):
+        results = measure(mode, runs)
+        print('%-10s import %.3f s  ready %.3f s  (best of %d)' % (
+            mode, min(r[0] for r in results), min(r[1] for r in results), runs))
+    print('Imports of app.py by cumulative time:')
+    for (cumulative, name) in import_profile():
+        print('%8.3f s  %s' % (cumulative / 1e6, name))
@@ -2,12 +2,47 @@ import urllib.request as urllib2
 import sqlite3.dbapi2 as sqlite
 import bs4 as bs
 import re
-from urllib.parse import urljoin
+import functools
+import hashlib
+import itertools
+import indexstore
+import math
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urljoin, urldefrag, urlsplit, urlunsplit, parse_qsl, urlencode
 from nltk.stem import porter
-from gensim.summarization import summarize
 
 ignorewords = set(['the', 'of', 'to', 'and', 'a', 'in', 'is', 'it', 'for'])
 
+SUMMARY_WORDS = 50  # Length of stored page summary
+SNIPPET_LENGTH = 200  # Maximum stored length of a single sentence
+
+splitter = re.compile('\\W+')
+sentence_splitter = re.compile('(?<=[.!?])\\s+|\n+')
+
+# States of url's in crawl frontier
+PENDING = 0
+DONE = 1
+FAILED = 2
+FRONTIER_BATCH = 50  # Pages fetched before analyzing and committing them
+
+# Maximum number of differing fingerprint bits of near-duplicates. Catches most pages differing
+# in 1% of their words: 3 of 300 words in about 4 of 5 cases, 10 of 1000 words in 4 of 5 cases.
+# Unrelated pages differ in more than 16 bits.
+SIMHASH_DISTANCE = 6
+# Fingerprint is split in blocks of 8 bits. Near-duplicates differ in at most SIMHASH_DISTANCE
+# blocks, so they have at least 2 equal blocks and every pair of blocks is an LSH band of 16 bits.
+# An unrelated page shares one of the 28 bands with probability 28 / 2^16, find_duplicate compares
+# about N / 2300 candidates of N pages where single block bands of 8 bits gave N / 32.
+SIMHASH_BLOCKS = 8
+SIMHASH_BANDS = list(itertools.combinations(range(SIMHASH_BLOCKS), 2))
+SIMHASH_MIN_WORDS = 50  # Shorter pages are not fingerprinted, they are too alike
+SHINGLE_SIZE = 3  # Words per shingle hashed into fingerprint
+
+BLOOM_CAPACITY = 100000  # Minimum number of url's in Bloom filter
+BLOOM_ERROR_RATE = 0.0001
+tracking_params = ('utm_', 'fbclid', 'gclid', 'mc_cid', 'mc_eid')
+default_ports = {'http': ':80', 'https': ':443'}
+
 webpages = [
     'http://azil.rs/en/',
     'http://www.unhcr.org/non-governmental-organizations.html',
@@ -18,16 +53,41 @@ webpages = [
 
 
 class Crawler:
-    # Initialize the crawler with the name of database
-    def __init__(self, dbname):
+    # Initialize the crawler with the name of database and number of shards (default detected)
+    def __init__(self, dbname, shards=None):
+        # Shards are detected before the index database is created
+        names = indexstore.shard_names(dbname, shards)
         self.conn = sqlite.connect(dbname)
+        # Postings are routed to shards by urlid, everything else stays in dbname
+        self.shards = [self.conn if name == dbname else sqlite.connect(name) for name in names]
+        for (name, shard) in zip(names, self.shards):
+            if indexstore.has_table(shard, 'wordlocation'):
+                raise sqlite.OperationalError(
+                    'index %s has postings in old wordlocation table, migrate it with `python indexstore.py %s`'
+                    % (name, dbname)
+                )
 
     def __del__(self):
+        for shard in self.shards:
+            if shard is not self.conn:
+                shard.close()
         self.conn.close()
 
     def dbcommit(self):
+        # Shards first, so a page marked as crawled always has its postings
+        for shard in self.shards:
+            if shard is not self.conn:
+                shard.commit()
         self.conn.commit()
 
+    def shard(self, urlid):
+        """
+        Returns connection to shard holding postings of url.
+
+        :param urlid: ID of url
+        """
+        return self.shards[indexstore.shard_of(urlid, len(self.shards))]
+
     def get_entry_id(self, table, field, value, createnew=True):
         """
         Auxiliary function for getting an entry ID and adding it
@@ -60,31 +120,90 @@ class Crawler:
         """
         if self.is_indexed(url):
             return
-        print('Indexing:', url)
-
-        # Get individual words
-        text = self.get_text(soup)
+        self.index_page(url, analyze_text(self.get_text(soup)))
 
-        # sum_text = summarize(text)
+    def index_page(self, url, analysis):
+        """
+        Storing words, sentences and summary of an analyzed page
 
-        words = self.separate_words(text)  # list of stemmed words
+        :param url: Web page url
+        :param analysis: result of analyze_text for the page text
+        """
+        words, sentences, summary, fingerprint = analysis  # stemmed words, [(location, sentence)], summary, simhash
 
         # Get URL id
         urlid = self.get_entry_id('urllist', 'url', url)
-        # self.conn.execute(
-        #     "UPDATE urllist SET pagetext='%s' WHERE rowid=%d " % (sum_text, urlid)
-        # )
+        if fingerprint is not None:
+            canonicalid = self.find_duplicate(fingerprint, urlid)
+            if canonicalid is not None:
+                print('Duplicate:', url, 'of', canonicalid)
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO urlalias(urlid, canonicalid) VALUES (?, ?)', (urlid, canonicalid)
+                )
+                return
+            self.add_fingerprint(urlid, fingerprint)
 
-        # Link each word to this url
-        # todo make it more efficient
+        print('Indexing:', url)
+        self.conn.execute(
+            'UPDATE urllist SET pagetext = ? WHERE rowid = ?', (summary, urlid)
+        )
+        self.conn.execute(
+            'INSERT OR REPLACE INTO pagesentences(urlid, locations, sentences) VALUES (?, ?, ?)',
+            (urlid,) + indexstore.encode_sentences(sentences)
+        )
+
+        # Link each word to this url, one row of compressed locations per word
+        locations = {}
         for i in range(len(words)):
             word = words[i]
             if word in ignorewords:
                 continue
-            wordid = self.get_entry_id('wordlist', 'word', word)
-            self.conn.execute(
-                'INSERT INTO wordlocation(urlid, wordid, location) VALUES (%d, %d, %d)' % (urlid, wordid, i)
-            )
+            locations.setdefault(word, []).append(i)
+        wordids = dict((word, self.get_entry_id('wordlist', 'word', word)) for word in locations)
+        self.shard(urlid).executemany(
+            'INSERT OR REPLACE INTO postings(wordid, urlid, count, positions) VALUES (?, ?, ?, ?)',
+            [
+                (wordids[word], urlid, len(positions), indexstore.encode_positions(positions))
+                for (word, positions) in locations.items()
+            ]
+        )
+
+    def find_duplicate(self, fingerprint, urlid):
+        """
+        Returns another indexed page whose fingerprint differs in at most
+        SIMHASH_DISTANCE bits. Only pages sharing a band of the fingerprint are compared.
+
+        :param fingerprint: simhash of page
+        :param urlid: ID of url of the page
+        :return: urlid of canonical page or None
+        """
+        bands = simhash_bands(fingerprint)
+        cursor = self.conn.execute(
+            'SELECT DISTINCT f.urlid, f.simhash FROM simhashband b JOIN fingerprint f ON f.urlid = b.urlid '
+            'WHERE f.urlid != ? AND (%s)' % ' OR '.join(['(b.band = ? AND b.value = ?)'] * len(bands)),
+            [urlid] + [value for band in enumerate(bands) for value in band]
+        )
+        for (urlid, simhash) in cursor:
+            if bin((simhash ^ fingerprint) & 0xffffffffffffffff).count('1') <= SIMHASH_DISTANCE:
+                return urlid
+        return None
+
+    def add_fingerprint(self, urlid, fingerprint):
+        """
+        Store fingerprint of page and its bands in LSH index, replacing
+        those of an earlier crawl of the page.
+
+        :param urlid: ID of url
+        :param fingerprint: simhash of page
+        """
+        self.conn.execute(
+            'INSERT OR REPLACE INTO fingerprint(urlid, simhash) VALUES (?, ?)', (urlid, to_signed(fingerprint))
+        )
+        self.conn.execute('DELETE FROM simhashband WHERE urlid = ?', (urlid,))
+        self.conn.executemany(
+            'INSERT INTO simhashband(band, value, urlid) VALUES (?, ?, ?)',
+            [(band, value, urlid) for (band, value) in enumerate(simhash_bands(fingerprint))]
+        )
 
     def get_text(self, soup):
         """
@@ -111,10 +230,7 @@ class Crawler:
         :param text: plain text from HTML page
         :return: list of words
         """
-        splitter = re.compile('\\W*')
-        stemmer = porter.PorterStemmer()
-        word_list = [stemmer.stem(s) for s in splitter.split(text) if s != '']
-        return word_list
+        return separate_words(text)
 
     def is_indexed(self, url):
         """
@@ -127,61 +243,375 @@ class Crawler:
             "SELECT rowid FROM urllist WHERE url = '%s'" % url
         ).fetchone()
         if u is not None:
-            # Check if it has actually been crawled
+            # Check if it has actually been crawled, sentences are indexed by urlid unlike postings
             v = self.conn.execute(
-                'SELECT * FROM wordlocation WHERE urlid = %d' % u[0]
+                'SELECT urlid FROM pagesentences WHERE urlid = %d' % u[0]
+            ).fetchone()
+            if v is not None:
+                return True
+            # Near-duplicates are crawled but only recorded as alias
+            v = self.conn.execute(
+                'SELECT * FROM urlalias WHERE urlid = %d' % u[0]
             ).fetchone()
             if v is not None:
                 return True
         return False
 
-    def crawl(self, pages=webpages, depth=2, pattern='http'):
+    def crawl(self, pages=webpages, depth=2, pattern='http', workers=0):
         """
         Starting with a list of pages do a breadth
         first search to the given depth, indexing pages as we go
 
+        The frontier is kept in the database, so an interrupted crawl
+        continues where it stopped when crawl is called again. Pages
+        that failed to download are retried then.
+
         :param pages: list of pages to start crawling from
         :param depth: maximum depth for crawling pages
         :param pattern: pattern for starting url
+        :param workers: (default 0) -> number of processes analyzing page text, 0 analyzes in this process
+        """
+        self.upgrade_index_tables()
+        self.create_frontier_table()
+        self.seen = self.load_seen()
+        # Pages that failed to download in an earlier crawl get another try
+        self.conn.execute('UPDATE frontier SET state = ? WHERE state = ?', (PENDING, FAILED))
+        for page in pages:
+            self.add_to_frontier(page, 0)
+        self.dbcommit()
+
+        pool = ProcessPoolExecutor(workers) if workers > 0 else None
+        try:
+            while True:
+                batch = self.conn.execute(
+                    'SELECT url, COALESCE(fetchurl, url), depth FROM frontier WHERE state = ? AND depth < ? '
+                    'ORDER BY depth, priority DESC LIMIT ?', (PENDING, depth, FRONTIER_BATCH)
+                ).fetchall()
+                if not batch:
+                    break
+                self.crawl_batch(batch, depth, pattern, pool)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def crawl_batch(self, batch, depth, pattern, pool=None):
+        """
+        Fetch and index a batch of pending frontier pages. Page texts are
+        analyzed in the pool if given.
+
+        :param batch: list of tuples (normalized url, url as found, depth) from frontier
+        :param depth: maximum depth for crawling pages
+        :param pattern: pattern for starting url
+        :param pool: executor for analyze_text or None
+        """
+        fetched = []
+        links_found = {}  # {normalized url: number of links} to url's already seen
+        for (key, page, page_depth) in batch:
+            try:
+                c = urllib2.urlopen(page)
+                print('Prosao', page)
+            except:
+                print('Usrao ga bajo hua', page)
+                self.conn.execute('UPDATE frontier SET state = ? WHERE url = ?', (FAILED, key))
+                continue
+            soup = bs.BeautifulSoup(c.read(), 'html.parser')
+            if not self.is_indexed(page):
+                fetched.append((key, page, self.get_text(soup)))
+            else:
+                self.conn.execute('UPDATE frontier SET state = ? WHERE url = ?', (DONE, key))
+
+            if page_depth + 1 >= depth:
+                continue
+            links = soup('a')
+            for link in links:
+                if 'href' in dict(link.attrs):
+                    url = urljoin(page, link['href'])
+                    if url.find("'") != -1:
+                        # example: javascript:printOrder('http://www.serbianrailways.com/active/.../print.html')
+                        continue
+                    key = normalize_url(url)
+                    if key[0:4] != pattern:
+                        continue
+                    if key not in self.seen:
+                        print("add to new pages", url)
+                        self.add_to_frontier(url, page_depth + 1)
+                    else:
+                        links_found[key] = links_found.get(key, 0) + 1
+        # Pending pages linked from more pages are fetched first
+        self.conn.executemany(
+            'UPDATE frontier SET priority = priority + ? WHERE url = ? AND state = ?',
+            [(count, url, PENDING) for (url, count) in links_found.items()]
+        )
+        self.dbcommit()
+
+        texts = [text for (key, page, text) in fetched]
+        analyses = pool.map(analyze_text, texts) if pool is not None else map(analyze_text, texts)
+        for ((key, page, text), analysis) in zip(fetched, analyses):
+            self.index_page(page, analysis)
+            # Marked in the same transaction as the page is indexed
+            self.conn.execute('UPDATE frontier SET state = ? WHERE url = ?', (DONE, key))
+            self.dbcommit()
+
+    def add_to_frontier(self, url, depth):
+        """
+        Add url to frontier as pending. Frontier is keyed by normalized url,
+        the url is fetched and indexed as it was found. Adding an url
+        already pending in frontier raises its priority.
+
+        :param url: absolute url as found
+        :param depth: depth at which url was found
+        """
+        key = normalize_url(url)
+        self.seen.add(key)
+        cursor = self.conn.execute(
+            'INSERT OR IGNORE INTO frontier(url, fetchurl, depth, priority, state) VALUES (?, ?, ?, 0, ?)',
+            (key, urldefrag(url.strip())[0], depth, PENDING)
+        )
+        if cursor.rowcount == 0:
+            self.conn.execute(
+                'UPDATE frontier SET priority = priority + 1 WHERE url = ? AND state = ?', (key, PENDING)
+            )
+
+    def load_seen(self):
+        """
+        Builds Bloom filter of url's already indexed or in frontier,
+        used instead of querying database for every discovered link.
+
+        :return: BloomFilter
         """
-        for i in range(depth):
-            new_pages = set()
-            for page in pages:
-                try:
-                    c = urllib2.urlopen(page)
-                    print('Prosao', page)
-                except:
-                    print('Usrao ga bajo hua', page)
-                    continue
-                soup = bs.BeautifulSoup(c.read(), 'html.parser')
-                self.add_to_index(page, soup)
-
-                links = soup('a')
-                for link in links:
-                    if 'href' in dict(link.attrs):
-                        url = urljoin(page, link['href'])
-                        if url.find("'") != -1:
-                            # example: javascript:printOrder('http://www.serbianrailways.com/active/.../print.html')
-                            continue
-                        url = url.split('#')[0]  # remove location portion
-                        if url[0:4] == pattern and not self.is_indexed(url):
-                            print("add to new pages", url)
-                            new_pages.add(url)
-                self.dbcommit()
-            pages = new_pages
+        count = self.conn.execute('SELECT COUNT(*) FROM urllist').fetchone()[0] + \
+            self.conn.execute('SELECT COUNT(*) FROM frontier').fetchone()[0]
+        seen = BloomFilter(max(count * 2, BLOOM_CAPACITY))
+        for (url,) in self.conn.execute('SELECT url FROM urllist'):
+            seen.add(normalize_url(url))
+        for (url,) in self.conn.execute('SELECT url FROM frontier'):
+            seen.add(url)
+        return seen
+
+    def upgrade_index_tables(self):
+        """
+        Add tables and columns missing from an index created by an older version
+        """
+        indexstore.upgrade_index_tables(self.conn)
+        self.rebuild_simhash_bands()
+        self.dbcommit()
+
+    def rebuild_simhash_bands(self):
+        """
+        Rebuild LSH index from stored fingerprints if it was built
+        with a different number of bands
+        """
+        bands = self.conn.execute('SELECT MAX(band) FROM simhashband').fetchone()[0]
+        if bands is None or bands == len(SIMHASH_BANDS) - 1:
+            return
+        self.conn.execute('DELETE FROM simhashband')
+        self.conn.executemany(
+            'INSERT INTO simhashband(band, value, urlid) VALUES (?, ?, ?)',
+            [
+                (band, value, urlid)
+                for (urlid, fingerprint) in self.conn.execute('SELECT urlid, simhash FROM fingerprint').fetchall()
+                for (band, value) in enumerate(simhash_bands(fingerprint))
+            ]
+        )
+
+    def create_frontier_table(self):
+        """
+        Create table of crawl frontier if it doesn't exist
+        """
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS frontier(url PRIMARY KEY, fetchurl VARCHAR, depth INTEGER, priority INTEGER, '
+            'state INTEGER)'
+        )
+        if 'fetchurl' not in [row[1] for row in self.conn.execute('PRAGMA table_info(frontier)')]:
+            # Frontier of an older version, its url's are fetched normalized
+            self.conn.execute('ALTER TABLE frontier ADD COLUMN fetchurl VARCHAR')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS frontieridx ON frontier(state, depth, priority)')
+        self.dbcommit()
 
     def create_index_tables(self):
         """
         Toxic method to create db schema and database tables
         """
-        self.conn.execute('CREATE TABLE urllist(url)')  # , pagetext VARCHAR
+        self.conn.execute('CREATE TABLE urllist(url, pagetext VARCHAR)')
         self.conn.execute('CREATE TABLE wordlist(word)')
-        self.conn.execute('CREATE TABLE wordlocation(urlid, wordid, location)')
         self.conn.execute('CREATE TABLE link(fromid INTEGER, toid INTEGER )')
         self.conn.execute('CREATE TABLE linkwords(wordid, linkid)')
         self.conn.execute('CREATE INDEX wordidx ON wordlist(word)')
         self.conn.execute('CREATE INDEX urlidx ON urllist(url)')
-        self.conn.execute('CREATE INDEX wordurlidx ON wordlocation(wordid)')
         self.conn.execute('CREATE INDEX urltoidx ON link(toid)')
         self.conn.execute('CREATE INDEX urlfromidx ON link(fromid)')
-        self.dbcommit()
+        for shard in self.shards:
+            indexstore.create_postings_table(shard)
+        self.upgrade_index_tables()
+        self.create_frontier_table()
+
+
+def separate_words(text):
+    """
+    Returning list of stemmed words by separating non-whitespace character
+
+    :param text: plain text from HTML page
+    :return: list of words
+    """
+    stemmer = porter.PorterStemmer()
+    return [stemmer.stem(s) for s in splitter.split(text) if s != '']
+
+
+def analyze_text(text):
+    """
+    Split page text into stemmed words, sentences, an extractive summary and
+    a near-duplicate fingerprint. Module level function so it can run in a process pool.
+
+    Sentence locations are word locations of their first word, so a sentence
+    containing any word location can be found with the sentence index.
+
+    :param text: plain text from HTML page
+    :return: tuple (words, [(location, sentence), ...], summary, simhash or None for short pages)
+    """
+    stemmer = porter.PorterStemmer()
+    words = []
+    sentences = []
+    for sentence in sentence_splitter.split(text):
+        sentence = ' '.join(sentence.split())
+        sentence_words = [stemmer.stem(s) for s in splitter.split(sentence) if s != '']
+        if not sentence_words:
+            continue
+        sentences.append((len(words), sentence[:SNIPPET_LENGTH]))
+        words.extend(sentence_words)
+    fingerprint = simhash(words) if len(words) >= SIMHASH_MIN_WORDS else None
+    return words, sentences, summarize_text(text, sentences), fingerprint
+
+
+def summarize_text(text, sentences):
+    """
+    Returns extractive summary of page text. Short pages which gensim
+    can't summarize, or every page when gensim has no summarizer, get
+    their leading sentences instead.
+
+    :param text: plain text from HTML page
+    :param sentences: list of tuples (location, sentence) of the page
+    :return: summary of about SUMMARY_WORDS words
+    """
+    summarize = load_summarizer()
+    summary = ''
+    if summarize is not None:
+        try:
+            summary = summarize(text, word_count=SUMMARY_WORDS)
+        except ValueError:
+            pass
+    if not summary:
+        picked = []
+        for (location, sentence) in sentences:
+            if location >= SUMMARY_WORDS:
+                break
+            picked.append(sentence)
+        summary = ' '.join(picked)
+    return ' '.join(summary.split())
+
+
+@functools.lru_cache(maxsize=None)
+def load_summarizer():
+    """
+    Returns gensim summarize function, or None with gensim 4.0 and newer
+    which no longer have gensim.summarization. Imported once per process,
+    gensim is slow to import and only crawling needs it.
+    """
+    try:
+        from gensim.summarization import summarize
+    except ImportError:
+        return None
+    return summarize
+
+
+def simhash(words):
+    """
+    Returns 64 bit SimHash of page from hashes of its word shingles.
+    Pages with mostly the same shingles get fingerprints differing in few bits.
+
+    :param words: list of stemmed words
+    :return: fingerprint
+    """
+    words = [word for word in words if word not in ignorewords]
+    shingles = {}
+    for i in range(max(len(words) - SHINGLE_SIZE + 1, 1)):
+        shingle = ' '.join(words[i:i + SHINGLE_SIZE])
+        shingles[shingle] = shingles.get(shingle, 0) + 1
+    weights = [0] * 64
+    for (shingle, count) in shingles.items():
+        h = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+        for bit in range(64):
+            if h >> bit & 1:
+                weights[bit] += count
+            else:
+                weights[bit] -= count
+    fingerprint = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def simhash_bands(fingerprint):
+    """
+    Returns LSH keys of fingerprint, one 16 bit value per pair of blocks in SIMHASH_BANDS.
+    """
+    width = 64 // SIMHASH_BLOCKS
+    blocks = [fingerprint >> (block * width) & ((1 << width) - 1) for block in range(SIMHASH_BLOCKS)]
+    return [blocks[first] << width | blocks[second] for (first, second) in SIMHASH_BANDS]
+
+
+def to_signed(fingerprint):
+    """
+    Converts 64 bit fingerprint to a value SQLite INTEGER can hold.
+    """
+    return fingerprint - (1 << 64) if fingerprint >= 1 << 63 else fingerprint
+
+
+def normalize_url(url):
+    """
+    Returns canonical form of url, so trivially different forms
+    of the same page are fetched only once. Lowercases scheme and host,
+    drops default port, fragment, tracking parameters and trailing slash.
+    Used only as key of seen url's, pages are fetched by url as found.
+
+    :param url: absolute url
+    :return: normalized url
+    """
+    scheme, netloc, path, query, fragment = urlsplit(url.strip())
+    scheme = scheme.lower()
+    netloc = netloc.lower()
+    if netloc.endswith(default_ports.get(scheme, ' ')):
+        netloc = netloc[:-len(default_ports[scheme])]
+    if len(path) > 1 and path.endswith('/'):
+        path = path.rstrip('/')
+    if path == '':
+        path = '/'
+    params = [
+        (k, v) for (k, v) in parse_qsl(query, keep_blank_values=True) if not k.lower().startswith(tracking_params)
+    ]
+    return urlunsplit((scheme, netloc, path, urlencode(params), ''))
+
+
+class BloomFilter:
+    """
+    Set membership with fixed memory and no false negatives. Url's
+    falsely reported as seen (about BLOOM_ERROR_RATE of them) are not crawled.
+    """
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        self.size = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray(self.size // 8 + 1)
+
+    def positions(self, item):
+        # Double hashing with two halves of one digest
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self.positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(item))
@@ -0,0 +1,245 @@
+import bisect
+import itertools
+import os
+import sys
+import zlib
+import sqlite3.dbapi2 as sqlite
+from array import array
+
+# Number of shard files of a new index, e.g. Crawler(dbname, shards=N) overrides it.
+# Existing indexes are detected from shard files.
+SHARDS = 1
+
+
+def shard_name(dbname, shard):
+    """
+    Returns name of shard file, e.g. searchindex.db -> searchindex.shard0.db
+
+    :param dbname: name of index database
+    :param shard: number of shard
+    :return: shard file name
+    """
+    root, ext = os.path.splitext(dbname)
+    return '%s.shard%d%s' % (root, shard, ext)
+
+
+def shard_count(dbname):
+    """
+    Returns number of shards of an existing index, 1 if postings
+    are kept in the index database itself. A new index gets SHARDS.
+
+    :param dbname: name of index database
+    """
+    shards = 0
+    while os.path.exists(shard_name(dbname, shards)):
+        shards += 1
+    if shards == 0:
+        return 1 if os.path.exists(dbname) else SHARDS
+    return shards
+
+
+def shard_names(dbname, shards=None):
+    """
+    Returns database files holding postings of the index. An index with one
+    shard keeps postings in the index database.
+
+    :param dbname: name of index database
+    :param shards: (default detected) -> number of shards
+    :return: list of file names ordered by shard number
+    """
+    shards = shards or shard_count(dbname)
+    if shards == 1:
+        return [dbname]
+    return [shard_name(dbname, shard) for shard in range(shards)]
+
+
+def shard_of(urlid, shards):
+    """
+    Returns number of shard holding postings of url.
+    """
+    return urlid % shards
+
+
+def encode_positions(positions):
+    """
+    Encodes sorted word locations as deltas from the previous
+    location, each stored as a varint (7 bits per byte, high bit
+    set on all but the last byte).
+
+    :param positions: sorted list of locations
+    :return: bytes
+    """
+    out = bytearray()
+    previous = 0
+    for position in positions:
+        delta = position - previous
+        previous = position
+        while delta >= 0x80:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+
+def decode_positions(blob):
+    """
+    Decodes locations stored by encode_positions.
+
+    :param blob: encoded locations
+    :return: array of locations
+    """
+    if max(blob, default=0) < 0x80:
+        # Every delta fits in one byte, the common case for frequent words
+        return array('I', itertools.accumulate(blob))
+    positions = array('I')
+    position = 0
+    delta = 0
+    shift = 0
+    for byte in blob:
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            position += delta
+            positions.append(position)
+            delta = 0
+            shift = 0
+    return positions
+
+
+def first_position(blob):
+    """
+    Decodes only the first location stored by encode_positions.
+    """
+    position = 0
+    shift = 0
+    for byte in blob:
+        position |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    return position
+
+
+def encode_sentences(sentences):
+    """
+    Packs sentences of a page into one row: locations of their first
+    words as encoded by encode_positions and their text, one sentence
+    per line, compressed with zlib.
+
+    :param sentences: list of tuples (location, sentence) ordered by location
+    :return: tuple (locations blob, sentences blob)
+    """
+    locations = encode_positions([location for (location, sentence) in sentences])
+    text = '\n'.join(sentence for (location, sentence) in sentences)
+    return locations, zlib.compress(text.encode('utf-8'))
+
+
+def sentence_at(locations, sentences, location):
+    """
+    Returns sentence of a page containing word location.
+
+    :param locations: locations blob from encode_sentences
+    :param sentences: sentences blob from encode_sentences
+    :param location: word location in page
+    :return: sentence or None if page has no sentence there
+    """
+    i = bisect.bisect_right(decode_positions(locations), location) - 1
+    if i < 0:
+        return None
+    return zlib.decompress(sentences).decode('utf-8').split('\n')[i]
+
+
+def create_postings_table(conn):
+    """
+    Creates table of compressed postings, one row per word and url.
+
+    :param conn: shard connection
+    """
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS postings(wordid INTEGER, urlid INTEGER, count INTEGER, positions BLOB, '
+        'PRIMARY KEY (wordid, urlid)) WITHOUT ROWID'
+    )
+
+
+def upgrade_index_tables(conn):
+    """
+    Adds tables and columns missing from an index database created by an
+    older version: page summaries, the sentence index and the near-duplicate
+    tables. Safe to run on any index.
+
+    :param conn: connection to index database
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS pagesentences(urlid INTEGER PRIMARY KEY, locations BLOB, sentences BLOB)')
+    if has_table(conn, 'pagesentence'):
+        # One row per sentence, repack them into one row per page
+        rows = conn.execute('SELECT urlid, location, sentence FROM pagesentence ORDER BY urlid, location')
+        conn.executemany(
+            'INSERT OR REPLACE INTO pagesentences(urlid, locations, sentences) VALUES (?, ?, ?)',
+            (
+                (urlid,) + encode_sentences([row[1:] for row in group])
+                for (urlid, group) in itertools.groupby(rows, lambda r: r[0])
+            )
+        )
+        conn.execute('DROP TABLE pagesentence')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(urllist)')]
+    if columns and 'pagetext' not in columns:
+        conn.execute('ALTER TABLE urllist ADD COLUMN pagetext VARCHAR')
+    conn.execute('CREATE TABLE IF NOT EXISTS fingerprint(urlid INTEGER PRIMARY KEY, simhash INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS simhashband(band INTEGER, value INTEGER, urlid INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS urlalias(urlid INTEGER PRIMARY KEY, canonicalid INTEGER)')
+    conn.execute('CREATE INDEX IF NOT EXISTS simhashbandidx ON simhashband(band, value)')
+    conn.execute('CREATE INDEX IF NOT EXISTS simhashbandurlidx ON simhashband(urlid)')
+
+
+def has_table(conn, table):
+    """
+    Returns True if database has the table.
+    """
+    cursor = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return cursor.fetchone() is not None
+
+
+def migrate(dbname):
+    """
+    Brings an index up to date: adds tables missing from the index database,
+    converts every shard from one wordlocation row per word occurrence to
+    compressed postings and drops wordlocation. Already migrated shards
+    are left as they are.
+
+    :param dbname: name of index database
+    :return: tuple (bytes before, bytes after) of all shard files
+    """
+    conn = sqlite.connect(dbname)
+    upgrade_index_tables(conn)
+    conn.commit()
+    conn.close()
+    before = after = 0
+    for name in shard_names(dbname):
+        before += os.path.getsize(name)
+        conn = sqlite.connect(name)
+        create_postings_table(conn)
+        if has_table(conn, 'wordlocation'):
+            rows = conn.execute('SELECT wordid, urlid, location FROM wordlocation ORDER BY wordid, urlid, location')
+            conn.executemany(
+                'INSERT OR REPLACE INTO postings(wordid, urlid, count, positions) VALUES (?, ?, ?, ?)',
+                (
+                    (wordid, urlid, len(locations), encode_positions(locations))
+                    for ((wordid, urlid), locations) in (
+                        (key, [row[2] for row in group]) for (key, group) in itertools.groupby(rows, lambda r: r[:2])
+                    )
+                )
+            )
+            conn.execute('DROP TABLE wordlocation')
+        conn.commit()
+        conn.execute('VACUUM')
+        conn.close()
+        after += os.path.getsize(name)
+    return before, after
+
+
+if __name__ == '__main__':
+    # python indexstore.py [searchindex.db] -> migrate index to compressed postings and current schema
+    dbname = sys.argv[1] if len(sys.argv) > 1 else 'searchindex.db'
+    before, after = migrate(dbname)
+    print('Migrated %s: %d -> %d bytes (%.1fx smaller)' % (dbname, before, after, float(before) / max(after, 1)))
@@ -15,7 +15,8 @@ def d_tanh(y):
 # One object per query
 class SearchNet:
     def __init__(self, dbname):
-        self.conn = sqlite.connect(dbname)
+        # Searcher may create the net in a warm up thread and use it from request threads
+        self.conn = sqlite.connect(dbname, check_same_thread=False)
 
     def __del__(self):
         self.conn.close()
@@ -1,9 +1,12 @@
+import heapq
+import itertools
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import indexstore
 import neuralnet
 import sqlite3.dbapi2 as sqlite
 from nltk.stem import porter
-import crawler
-
-import gensim
 
 DB = 'searchindex.db'
 RET_SIZE = 10
@@ -12,90 +15,146 @@ default_page = 'http://www.unhcr.org/'
 
 RETURN_URL_LENGTH = 10
 
+# Weights of the signals combined by the top-K evaluator.
+# Frequency and location are per query word, distance is a per url bonus.
+FREQUENCY_WEIGHT = 1.0
+LOCATION_WEIGHT = 2.0
+DISTANCE_WEIGHT = 3.0
+# Weights of precomputed per url signals, used only when vectors are built
+TOPIC_WEIGHT = 1.0
+URLNAME_WEIGHT = 1.0
+# Batch queries keep postings of words they share in memory, unless the word is in more url's
+SHARED_POSTINGS_LIMIT = 10000
+
 
 class Searcher:
-    def __init__(self, dbname):
+    def __init__(self, dbname, shards=None):
         self.mynet = neuralnet.SearchNet('nn.db')
-        self.conn = sqlite.connect(dbname)
+        self.dbname = dbname
+        self.shard_names = indexstore.shard_names(dbname, shards)
+        self.local = threading.local()  # SQLite connections can only be used in thread that created them
+        self.connections = []  # Connections of every thread, closed together with the searcher
+        self.connections_lock = threading.Lock()
+        # Match and score work of sharded index runs on every shard in parallel
+        self.pool = ThreadPoolExecutor(len(self.shard_names)) if len(self.shard_names) > 1 else None
+        self.stemmer = porter.PorterStemmer()
+        self.doc_freq = {}  # Cached document frequencies {wordid: number of urls}
+        self.url_count = None
+        self.topic_index = None
+        self.topics_loaded = False
+        # Serving structures preloaded by warm_up, looked up in database until then
+        self.vocabulary = {}  # {word: wordid}
+        self.url_names = {}  # {urlid: url name}
+        for shard in range(len(self.shard_names)):
+            if indexstore.has_table(self.shard(shard), 'wordlocation'):
+                raise sqlite.OperationalError(
+                    'index %s has postings in old wordlocation table, migrate it with `python indexstore.py %s`'
+                    % (self.shard_names[shard], dbname)
+                )
 
     def __del__(self):
-        self.conn.close()
-
-    def get_match_rows(self, query):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+
+    def connect(self, name):
         """
-        Based on the query returns list of tuples 
-
-        This means the method will return all locations of words from query in one url,
-        and all url's that contain every word from the query. Basically each urlid appears multiple times, 
-        once for every combination of locations.
-
-        rows e.g.[(urlID, word_locations...), ...]
-        wordids e.g [wordid, ...]
+        Opens connection for the current thread and keeps track of it,
+        so connections of pool and request threads are closed too.
 
-        :param query: string containing sentence for searching
-        :returns: rows -> list of tuples, wordids -> list of word id's
+        :param name: database file name
+        :return: connection
         """
-        # Strings to build the query
-        field_list = 'w0.urlid'  # URL ID from first word from query
-        table_list = ''
-        clause_list = ''
-        wordids = []
+        # Used only by the thread that opened it, but closed from any thread
+        conn = sqlite.connect(name, check_same_thread=False)
+        with self.connections_lock:
+            self.connections.append(conn)
+        return conn
 
-        # Split the words by spaces
-        stemmer = porter.PorterStemmer()
-        words = [stemmer.stem(w) for w in query.split(' ')]  # todo izmena
-        table_number = 0
+    def close_thread(self):
+        """
+        Closes connections opened by the current thread. Short lived threads,
+        e.g. one per web request, call it when done. Pool threads keep theirs.
+        """
+        opened = []
+        if hasattr(self.local, 'conn'):
+            opened.append(self.local.conn)
+            del self.local.conn
+        if hasattr(self.local, 'shards'):
+            opened.extend(conn for conn in self.local.shards.values() if conn not in opened)
+            del self.local.shards
+        with self.connections_lock:
+            for conn in opened:
+                self.connections.remove(conn)
+                conn.close()
+
+    @property
+    def topics(self):
+        """
+        TopicIndex of the index database, loaded on first use. None until vectors are built.
+        """
+        if not self.topics_loaded:
+            self.load_topics()
+        return self.topic_index
 
-        for word in words:
-            # Get word ID, returns a tuple
-            wordrow = self.conn.execute(
-                "SELECT rowid FROM wordlist WHERE word = '%s'" % word
-            ).fetchone()
-            if wordrow is not None:
-                wordid = wordrow[0]  # Extract word ID from tuple
-                wordids.append(wordid)
-                # We need to concat query if there are more tables
-                if table_number > 0:
-                    table_list += ','
-                    clause_list += ' and '
-                    clause_list += 'w%d.urlid=w%d.urlid and ' % (table_number - 1, table_number)
-                field_list += ',w%d.location' % table_number  # From table wordlocation
-                table_list += 'wordlocation w%d' % table_number
-                # Extract wordid for every word in wordlocation table
-                clause_list += 'w%d.wordid=%d' % (table_number, wordid)
-                table_number += 1
-        # Create the query from the separate parts
-        # All url's(urlid) contain every word in the query
-        full_query = 'SELECT %s FROM %s WHERE %s' % (field_list, table_list, clause_list)
-        rows = []
-        try:
-            rows = self.conn.execute(full_query).fetchall()
-        except Exception:
-            return 'Error', wordids
-        return rows, wordids
+    def load_topics(self):
+        """
+        Loads topic vectors of the index database if they were built.
+        """
+        # numpy and scipy are imported only when vectors are used
+        import topicmodel
+        self.topic_index = topicmodel.load_topic_index(self.dbname)
+        self.topics_loaded = True
 
-    def get_scored_list(self, rows, word_ids):
+    def warm_up(self):
         """
-        Scoring result (rows) with various algorithms.
+        Preloads vocabulary, url names, url count and topic vectors so first
+        queries don't wait on them. Words and url's added to the index later
+        are still found trough the database.
+        """
+        self.vocabulary = dict(self.conn.execute('SELECT word, rowid FROM wordlist').fetchall())
+        self.url_names = dict(self.conn.execute('SELECT rowid, url FROM urllist').fetchall())
+        self.url_count = len(self.url_names)
+        self.load_topics()
 
-        :param rows: list of tuples e.g. (urlid, w0.location, w1.location...)
-        :param word_ids: list of word id's from query
-        :return: dict e.g.{urlid: rank}
+    @property
+    def conn(self):
+        """
+        Connection to index database of the current thread.
         """
-        total_scores = dict([(row[0], 0) for row in rows])
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = self.connect(self.dbname)
+        return self.local.conn
 
-        # Scoring functions
-        weights = [
-            (1.0, self.word_frequency_score(rows)),
-            (2.0, self.location_score(rows)),
-            (3.0, self.distance_score(rows)),
-        ]
+    def shard(self, shard):
+        """
+        Connection to shard of the current thread.
 
-        for (weight, scores) in weights:
-            for url in total_scores:
-                total_scores[url] += weight * scores[url]
+        :param shard: number of shard
+        :return: connection to shard database
+        """
+        if not hasattr(self.local, 'shards'):
+            self.local.shards = {}
+        if shard not in self.local.shards:
+            if self.shard_names[shard] == self.dbname:
+                self.local.shards[shard] = self.conn
+            else:
+                self.local.shards[shard] = self.connect(self.shard_names[shard])
+        return self.local.shards[shard]
+
+    def scatter(self, work):
+        """
+        Runs work on every shard, in parallel if the index is sharded.
 
-        return total_scores
+        :param work: function taking shard connection
+        :return: list of results ordered by shard
+        """
+        if self.pool is None:
+            return [work(self.shard(0))]
+        return list(self.pool.map(lambda shard: work(self.shard(shard)), range(len(self.shard_names))))
 
     def get_url_name(self, id):
         """
@@ -109,26 +168,445 @@ class Searcher:
         )
         return cursor.fetchone()[0]
 
-    def query(self, q):
+    def get_url_names(self, urlids):
         """
-        Method for querying indexed web pages and printing
+        Returns url names for many urlid's with a single lookup.
+
+        :param urlids: list of url id's
+        :return: dict e.g. {urlid: url name}
+        """
+        names = dict((urlid, self.url_names[urlid]) for urlid in urlids if urlid in self.url_names)
+        missing = [urlid for urlid in urlids if urlid not in names]
+        if missing:
+            cursor = self.conn.execute(
+                'SELECT rowid, url FROM urllist WHERE rowid IN (%s)' % ','.join('?' * len(missing)), missing
+            )
+            names.update(cursor.fetchall())
+        return names
+
+    def query(self, q, partial=False):
+        """
+        Method for querying indexed web pages and returning
         best matched url's.
 
         :param q: query string for search
+        :param partial: (default False) -> also rank url's that contain only some query words
+        :return: list of tuples e.g. [(score, url name), ...]
         """
-        rows, word_ids = self.get_match_rows(q)  # Get list of tuples (urlid, wordlocations...)
-        if rows == 'Error':
+        word_ids = self.get_word_ids(q)
+        if not word_ids:
+            return [(-1.0, default_page)]
+
+        ranked_scores = self.top_k(word_ids, RET_SIZE, partial)
+        if not ranked_scores:
             return [(-1.0, default_page)]
+        names = self.get_url_names([urlid for (score, urlid, location) in ranked_scores])
+        return [(score, names[urlid]) for (score, urlid, location) in ranked_scores]
+
+    def query_with_snippets(self, q, partial=False):
+        """
+        Same as query, but every url comes with a snippet of its text: the
+        sentence containing the most important query word, or the page summary.
+        Snippets are stored at crawl time and fetched together with url names.
+
+        :param q: query string for search
+        :param partial: (default False) -> also rank url's that contain only some query words
+        :return: list of tuples e.g. [(score, url name, snippet), ...]
+        """
+        word_ids = self.get_word_ids(q)
+        ranked_scores = self.top_k(word_ids, RET_SIZE, partial) if word_ids else []
+        if not ranked_scores:
+            return [(-1.0, default_page, '')]
+        pages = self.get_pages(ranked_scores)
+        return [(score, pages[urlid][0], pages[urlid][1]) for (score, urlid, location) in ranked_scores]
+
+    def get_pages(self, ranked_scores):
+        """
+        Returns url names and snippets for ranked url's with a single lookup.
+
+        :param ranked_scores: list of tuples (score, urlid, location) from top_k
+        :return: dict e.g. {urlid: (url name, snippet)}
+        """
+        hits = dict((urlid, location) for (score, urlid, location) in ranked_scores)
+        try:
+            cursor = self.conn.execute(
+                'SELECT u.rowid, u.url, u.pagetext, s.locations, s.sentences '
+                'FROM urllist u LEFT JOIN pagesentences s ON s.urlid = u.rowid '
+                'WHERE u.rowid IN (%s)' % ','.join('?' * len(hits)), list(hits)
+            )
+            pages = {}
+            for (urlid, url, summary, locations, sentences) in cursor:
+                snippet = None
+                if sentences is not None:
+                    snippet = indexstore.sentence_at(locations, sentences, hits[urlid])
+                pages[urlid] = (url, snippet or summary or '')
+            return pages
+        except sqlite.OperationalError:
+            # Index crawled before pages were summarized
+            names = self.get_url_names([urlid for (score, urlid, location) in ranked_scores])
+            return dict((urlid, (name, '')) for (urlid, name) in names.items())
+
+    def get_word_ids(self, query):
+        """
+        Stems words from query and resolves them to word id's with a single lookup.
+        Words that are not in the index are dropped.
+
+        :param query: string containing sentence for searching
+        :return: list of unique word id's in query order
+        """
+        words = self.stem_words(query)
+        return self.to_word_ids(words, self.resolve_words(words))
+
+    def stem_words(self, query):
+        """
+        Returns list of stemmed words from query.
+        """
+        return [self.stemmer.stem(w) for w in query.split(' ') if w != '']
+
+    def resolve_words(self, words):
+        """
+        Returns word id's of stemmed words, looking up words missing
+        from preloaded vocabulary with a single query.
+
+        :param words: iterable of stemmed words
+        :return: dict e.g. {word: wordid} of words found in index
+        """
+        words = set(words)
+        found = dict((word, self.vocabulary[word]) for word in words if word in self.vocabulary)
+        missing = [word for word in words if word not in found]
+        if missing:
+            cursor = self.conn.execute(
+                'SELECT word, rowid FROM wordlist WHERE word IN (%s)' % ','.join('?' * len(missing)), missing
+            )
+            found.update(cursor.fetchall())
+        return found
+
+    def to_word_ids(self, words, found):
+        """
+        Returns unique word id's of stemmed words in query order.
+
+        :param words: list of stemmed words
+        :param found: dict e.g. {word: wordid} from resolve_words
+        """
+        wordids = []
+        for word in words:
+            if word in found and found[word] not in wordids:
+                wordids.append(found[word])
+        return wordids
+
+    def query_many(self, queries, partial=False):
+        """
+        Batch version of query for bulk and offline evaluation. Stems of the
+        whole batch are resolved with one lookup, repeated queries are
+        evaluated once and postings of words used by several queries are
+        read once per shard (see top_k_many).
+
+        :param queries: list of query strings
+        :param partial: (default False) -> also rank url's that contain only some query words
+        :return: list of query results ordered as queries
+        """
+        words = [self.stem_words(q) for q in queries]
+        found = self.resolve_words(itertools.chain(*words))
+        keys = [tuple(self.to_word_ids(query_words, found)) for query_words in words]
+
+        distinct = [key for key in dict.fromkeys(keys) if key]
+        ranked = dict(zip(distinct, self.top_k_many([list(key) for key in distinct], RET_SIZE, partial)))
+        names = self.get_url_names(list(set(
+            urlid for ranked_scores in ranked.values() for (score, urlid, location) in ranked_scores
+        )))
+        results = []
+        for key in keys:
+            if not ranked.get(key):
+                results.append([(-1.0, default_page)])
+            else:
+                results.append([(score, names[urlid]) for (score, urlid, location) in ranked[key]])
+        return results
+
+    def load_doc_frequencies(self, wordids):
+        """
+        Caches document frequencies of many words with one query per shard.
+
+        :param wordids: iterable of word id's
+        """
+        missing = [wordid for wordid in wordids if wordid not in self.doc_freq]
+        if not missing:
+            return
+        query = 'SELECT wordid, COUNT(*) FROM postings WHERE wordid IN (%s) GROUP BY wordid' % \
+            ','.join('?' * len(missing))
+        freqs = dict((wordid, 0) for wordid in missing)
+        for rows in self.scatter(lambda conn: conn.execute(query, missing).fetchall()):
+            for (wordid, df) in rows:
+                freqs[wordid] += df
+        self.doc_freq.update(freqs)
+
+    def get_doc_frequency(self, wordid):
+        """
+        Returns number of url's containing the word in all shards.
+        Values are cached for the lifetime of the searcher.
+
+        :param wordid: ID of word
+        :return: document frequency
+        """
+        if wordid not in self.doc_freq:
+            self.doc_freq[wordid] = sum(self.scatter(lambda conn: conn.execute(
+                'SELECT COUNT(*) FROM postings WHERE wordid = ?', (wordid,)
+            ).fetchone()[0]))
+        return self.doc_freq[wordid]
+
+    def get_url_count(self):
+        """
+        Returns (cached) number of url's in the index.
+        """
+        if self.url_count is None:
+            self.url_count = self.conn.execute('SELECT COUNT(*) FROM urllist').fetchone()[0]
+        return self.url_count
+
+    def term_weights(self, wordids):
+        """
+        Weights every query word by its share of the query idf, so rare words
+        dominate the score and the score stays in the same range for any query.
+
+        :param wordids: word id's from query
+        :return: list of tuples e.g. [(wordid, weight, document frequency), ...]
+        """
+        url_count = self.get_url_count()
+        freqs = [(wordid, self.get_doc_frequency(wordid)) for wordid in wordids]
+        idfs = [(wordid, math.log(1.0 + float(url_count) / max(df, 1)), df) for (wordid, df) in freqs]
+        total = sum(idf for (wordid, idf, df) in idfs)
+        return [(wordid, idf / total, df) for (wordid, idf, df) in idfs]
 
-        scores = self.get_scored_list(rows, word_ids)
-        # Sort urls for query
-        ranked_scores = sorted([(score, url) for (url, score) in scores.items()], reverse=True)
-        # return ranked_scores[:10]
-        # this
-        return [(score, self.get_url_name(urlid)) for (score, urlid) in ranked_scores[:RET_SIZE]]
-        # for (score, urlid) in ranked_scores[0:10]:
-        #     print('%f\t%s' % (score, self.get_url_name(urlid)))
-        # return word_ids, [r[1] for r in ranked_scores[0:10]]
+    def term_score(self, weight, count, first):
+        """
+        Score of one query word in one url. Upper bound is weight * (FREQUENCY_WEIGHT + LOCATION_WEIGHT).
+
+        :param weight: query word weight
+        :param count: number of occurrences of word in url
+        :param first: first location of word in url
+        :return: score
+        """
+        return weight * (FREQUENCY_WEIGHT * count / (count + 1.0) +
+                         LOCATION_WEIGHT / (1.0 + math.log(1.0 + first)))
+
+    def distance_bonus(self, reader, urlid, wordids, matched):
+        """
+        Per url score based on how close the matched query words appear to one
+        another, scaled by the share of query words that matched. Upper bound is DISTANCE_WEIGHT.
+
+        :param reader: PostingsReader of shard
+        :param urlid: ID of url
+        :param wordids: word id's from query
+        :param matched: word id's from query found in url
+        :return: score
+        """
+        # If there's only one word everyone wins!
+        if len(wordids) == 1:
+            return DISTANCE_WEIGHT
+        if len(matched) < 2:
+            return 0.0
+        span = min_span([reader.locations(wordid, urlid) for wordid in matched])
+        coverage = float(len(matched) - 1) / (len(wordids) - 1)
+        return DISTANCE_WEIGHT * coverage * (len(matched) - 1) / max(span, len(matched) - 1)
+
+    def distance_bound(self, words, matched):
+        """
+        Upper bound of distance_bonus for an url matching some of the query words.
+
+        :param words: number of query words
+        :param matched: most query words the url can match
+        :return: bound
+        """
+        if words == 1:
+            return DISTANCE_WEIGHT
+        if matched < 2:
+            return 0.0
+        return DISTANCE_WEIGHT * float(matched - 1) / (words - 1)
+
+    def top_k(self, wordids, k=RET_SIZE, partial=False):
+        """
+        Top-K query evaluation with dynamic pruning. Url's that can't enter
+        the current top-K heap, even with the best possible score for the
+        rest of their words, are skipped before expensive lookups.
+
+        Without partial every word is required: url's are driven from the rarest
+        word and other words are probed in order of selectivity, so the cost
+        doesn't depend on how many url's contain common words.
+
+        With partial url's that contain any query word are ranked with MaxScore:
+        words whose bounds can't lift an url into the heap on their own are never
+        scanned, only probed for url's found trough rarer words.
+
+        Sharded index is evaluated on every shard in parallel with global word
+        weights and per shard top-K lists are merged.
+
+        :param wordids: word id's from query
+        :param k: number of returned url's
+        :param partial: (default False) -> rank url's containing only some words
+        :return: list of tuples sorted by score e.g. [(score, urlid, location), ...]
+                 where location is the first location of the most important matched word
+        """
+        return self.top_k_many([wordids], k, partial)[0]
+
+    def top_k_many(self, queries, k=RET_SIZE, partial=False):
+        """
+        Top-K evaluation of many queries in one pass over the shards.
+        Postings of words used by several queries are read once per shard and
+        kept in memory until the last query using them is evaluated. Words in
+        more than SHARED_POSTINGS_LIMIT url's are looked up per query instead,
+        their posting lists are too long to hold and mostly only probed.
+
+        :param queries: list of lists of word id's
+        :param k: number of returned url's per query
+        :param partial: (default False) -> rank url's containing only some words
+        :return: list of top_k results ordered as queries
+        """
+        self.load_doc_frequencies(set(itertools.chain(*queries)))
+        plans = []
+        for wordids in queries:
+            terms = sorted(self.term_weights(wordids), key=lambda t: t[2])
+            if partial:
+                terms = [t for t in terms if t[2] > 0]
+            if not terms or terms[0][2] == 0:
+                plans.append(None)
+            else:
+                plans.append((wordids, terms, self.url_scores(wordids)))
+        evaluate = self.max_score if partial else self.conjunctive
+
+        usage = {}  # {wordid: number of queries using the word}
+        for plan in plans:
+            for (wordid, weight, df) in (plan[1] if plan else []):
+                usage[wordid] = usage.get(wordid, 0) + 1
+        shared = dict(
+            (wordid, count) for (wordid, count) in usage.items()
+            if count > 1 and self.doc_freq[wordid] <= SHARED_POSTINGS_LIMIT
+        )
+
+        def work(conn):
+            reader = PostingsReader(conn, shared)
+            heaps = []
+            for plan in plans:
+                if plan is None:
+                    heaps.append([])
+                    continue
+                heaps.append(evaluate(reader, plan[0], plan[1], k, plan[2]))
+                reader.release([t[0] for t in plan[1]])
+            return heaps
+
+        per_shard = self.scatter(work)
+        return [heapq.nlargest(k, itertools.chain(*[heaps[i] for heaps in per_shard])) for i in range(len(plans))]
+
+    def conjunctive(self, reader, wordids, terms, k, url_scores):
+        """
+        Top-K over url's that contain all the words. Terms must be ordered
+        by document frequency, rarest first. url_scores is the result of
+        Searcher.url_scores for the query.
+
+        :return: heap of tuples (score, urlid, location)
+        """
+        bounds = [weight * (FREQUENCY_WEIGHT + LOCATION_WEIGHT) for (wordid, weight, df) in terms]
+        # Best score the words after i can still add
+        scores, bonus = url_scores
+        bonus += DISTANCE_WEIGHT  # Best per url bonus
+        rest = [sum(bounds[i + 1:]) + bonus for i in range(len(terms))]
+        heap = []
+        first_id, first_weight, df = terms[0]
+        for (urlid, count, first) in reader.postings(first_id):
+            threshold = heap[0][0] if len(heap) == k else 0.0
+            score = self.term_score(first_weight, count, first)
+            for i in range(1, len(terms)):
+                if score + rest[i - 1] <= threshold:
+                    break
+                hit = reader.probe(terms[i][0], urlid)
+                if hit is None:
+                    break
+                score += self.term_score(terms[i][1], hit[0], hit[1])
+            else:
+                if score + bonus > threshold:
+                    score += self.distance_bonus(reader, urlid, wordids, [t[0] for t in terms]) + lookup(scores, urlid)
+                    push_top_k(heap, k, (score, urlid, first))
+        return heap
+
+    def max_score(self, reader, wordids, terms, k, url_scores):
+        """
+        Top-K over url's that contain any of the words with MaxScore pruning.
+        url_scores is the result of Searcher.url_scores for the query.
+
+        Url's of the most important (rarest) word are scored first, they are
+        few and usually fill the heap with a threshold that common words can't
+        reach on their own. Remaining url's can only match the other words, so
+        the distance bonus bound counts only words that can still match.
+
+        :return: heap of tuples (score, urlid, location)
+        """
+        scores, url_bound = url_scores
+        terms = sorted(terms, key=lambda t: t[1])
+        seed_id, seed_weight, df = terms.pop()
+        bounds = [weight * (FREQUENCY_WEIGHT + LOCATION_WEIGHT) for (wordid, weight, df) in terms]
+        # prefix[i] -> best score words before i can add
+        prefix = [0.0]
+        for bound in bounds:
+            prefix.append(prefix[-1] + bound)
+
+        def bonus(matched):
+            # Best per url bonus of an url matching at most this many words
+            return self.distance_bound(len(wordids), matched) + url_bound
+
+        heap = []
+        seeded = set()
+        for (urlid, count, first) in reader.postings(seed_id):
+            seeded.add(urlid)
+            threshold = heap[0][0] if len(heap) == k else 0.0
+            score = self.term_score(seed_weight, count, first)
+            matched = [seed_id]
+            for i in reversed(range(len(terms))):
+                if score + prefix[i + 1] + bonus(len(matched) + i + 1) <= threshold:
+                    break
+                hit = reader.probe(terms[i][0], urlid)
+                if hit is not None:
+                    score += self.term_score(terms[i][1], hit[0], hit[1])
+                    matched.append(terms[i][0])
+            if score + bonus(len(matched)) <= threshold:
+                continue
+            score += self.distance_bonus(reader, urlid, wordids, matched) + lookup(scores, urlid)
+            push_top_k(heap, k, (score, urlid, first))
+
+        essential = 0  # Words before this index are only probed, never scanned
+        cursors = [iter(reader.postings(wordid)) for (wordid, weight, df) in terms]
+        heads = [next(cursor, None) for cursor in cursors]
+        while True:
+            threshold = heap[0][0] if len(heap) == k else 0.0
+            while essential < len(terms) and prefix[essential + 1] + bonus(essential + 1) <= threshold:
+                essential += 1
+            active = [i for i in range(essential, len(terms)) if heads[i] is not None]
+            if not active:
+                break
+            urlid = min(heads[i][0] for i in active)
+
+            score = 0.0
+            matched = []
+            location = None  # First location of the most important matched word
+            for i in active:
+                if heads[i][0] == urlid:
+                    score += self.term_score(terms[i][1], heads[i][1], heads[i][2])
+                    matched.append(terms[i][0])
+                    location = heads[i][2]
+                    heads[i] = next(cursors[i], None)
+            if urlid in seeded:
+                continue
+            for i in reversed(range(essential)):
+                if score + prefix[i + 1] + bonus(len(matched) + i + 1) <= threshold:
+                    break
+                hit = reader.probe(terms[i][0], urlid)
+                if hit is not None:
+                    score += self.term_score(terms[i][1], hit[0], hit[1])
+                    matched.append(terms[i][0])
+                    if location is None:
+                        location = hit[1]
+            if score + bonus(len(matched)) <= threshold:
+                continue
+
+            score += self.distance_bonus(reader, urlid, wordids, matched) + lookup(scores, urlid)
+            push_top_k(heap, k, (score, urlid, location))
+        return heap
 
     def normalize(self, scores, small_is_better=False):
         """
@@ -149,81 +627,175 @@ class Searcher:
                 maxscore = vsmall
             return dict([(u, float(c) / maxscore) for (u, c) in scores.items()])
 
-    def word_frequency_score(self, rows):
+    def nn_score(self, rows, wordids):
         """
-        Returns score based on frequency of words in document.
+        Returns score based on user clicks.
 
         :param rows: list of tuples [(urlid, w0.location, ...), ...]
+        :param wordids: word id's from query
         :return: dict of scores
         """
-        # Create dict {urlid: init_score}
-        counts = dict([(row[0], 0) for row in rows])
-        # Increment score for every occurrence of urlid in row tuple
-        for row in rows:
-            counts[row[0]] += 1
-        return self.normalize(counts)
+        # Get unique URL IDs as an ordered list
+        urlids = [urlid for urlid in set([row[0] for row in rows])]
+        nn_result = self.mynet.get_result(wordids, urlids)
+        scores = dict([(urlids[i], nn_result[i]) for i in range(len(urlids))])
+        return self.normalize(scores)
 
-    def location_score(self, rows):
+    def url_scores(self, wordids):
         """
-        Returns score based on how early words from query occurred
+        Weighted precomputed per url signals for the query.
 
-        :param rows: list of tuples [(urlid, w0.location, ...), ...]
-        :return: dict of scores
+        :param wordids: word id's from query
+        :return: tuple (array of scores indexed by urlid or None, highest score of the query)
         """
-        # Create dict {urlid: init_score}
-        locations = dict([(row[0], 1000000) for row in rows])
-        for row in rows:
-            # Sum all word locations from row tuple
-            loc = sum(row[1:])
-            if loc < locations[row[0]]:
-                locations[row[0]] = loc
-        return self.normalize(locations, small_is_better=True)
-
-    def distance_score(self, rows):
+        if self.topics is None:
+            return None, 0.0
+        scores = TOPIC_WEIGHT * self.topics.similarities(wordids) + \
+            URLNAME_WEIGHT * self.topics.urlname_matches(wordids)
+        return scores, float(scores.max())
+
+
+class PostingsReader:
+    """
+    Reads postings of one shard for the top-K evaluator. Postings of
+    shared words are read once and kept in memory until released by
+    the last query using them.
+    """
+    def __init__(self, conn, shared=None):
+        self.conn = conn
+        self.shared = dict(shared or {})  # {wordid: number of queries still using the word}
+        self.cache = {}  # {wordid: {urlid: (count, first location, positions blob)}} ordered by urlid
+        self.decoded = {}  # {wordid: {urlid: locations}} of shared words
+
+    def cached(self, wordid):
         """
-        Returns score based on how close words in query appear
-        to one another in document. Smallest distances are used
-        for calculation.
-
-        :param rows: list of tuples [(urlid, w0.location, ...), ...]
-        :return: dict of scores
+        Returns in memory postings of shared word.
         """
-        # If there's only one word everyone wins!
-        if len(rows[0]) <= 2:
-            return dict([(row[0], 1.0) for row in rows])
-
-        # Initialize dictionary with large values
-        min_distance = dict([(row[0], 1000000) for row in rows])
-
-        for row in rows:
-            # Calculating sum of distances between word locations in row tuple.
-            dist = sum([abs(row[i] - row[i - 1]) for i in range(2, len(row))])
-            if dist < min_distance[row[0]]:
-                min_distance[row[0]] = dist
-        return self.normalize(min_distance, small_is_better=True)
+        if wordid not in self.cache:
+            cursor = self.conn.execute(
+                'SELECT urlid, count, positions FROM postings WHERE wordid = ? ORDER BY urlid', (wordid,)
+            )
+            self.cache[wordid] = dict(
+                (urlid, (count, indexstore.first_position(positions), positions))
+                for (urlid, count, positions) in cursor
+            )
+        return self.cache[wordid]
+
+    def release(self, wordids):
+        """
+        Called after a query is evaluated, drops postings of shared
+        words no other query is going to use.
 
-    def nn_score(self, rows, wordids):
+        :param wordids: word id's of evaluated query
         """
-        Returns score based on user clicks.
+        for wordid in wordids:
+            if wordid not in self.shared:
+                continue
+            self.shared[wordid] -= 1
+            if self.shared[wordid] == 0:
+                del self.shared[wordid]
+                self.cache.pop(wordid, None)
+                self.decoded.pop(wordid, None)
+
+    def postings(self, wordid):
+        """
+        Iterates over url's containing the word, ordered by urlid.
 
-        :param rows: list of tuples [(urlid, w0.location, ...), ...]
-        :param wordids: word id's from query
-        :return: dict of scores
+        :param wordid: ID of word
+        :return: iterator of tuples e.g. (urlid, number of occurrences, first location)
         """
-        # Get unique URL IDs as an ordered list
-        urlids = [urlid for urlid in set([row[0] for row in rows])]
-        nn_result = self.mynet.get_result(wordids, urlids)
-        scores = dict([(urlids[i], nn_result[i]) for i in range(len(urlids))])
-        return self.normalize(scores)
+        if wordid in self.shared:
+            return ((urlid, hit[0], hit[1]) for (urlid, hit) in self.cached(wordid).items())
+        cursor = self.conn.execute(
+            'SELECT urlid, count, positions FROM postings WHERE wordid = ? ORDER BY urlid', (wordid,)
+        )
+        return ((urlid, count, indexstore.first_position(positions)) for (urlid, count, positions) in cursor)
 
-    def topic_score(self):
-        pass
+    def probe(self, wordid, urlid):
+        """
+        Looks up a single word in a single url.
 
-    def urlname_score(self, rows, wordids):
-        pass #urlnames = [self.get_url_name(rows) for row[0] in rows]
+        :param wordid: ID of word
+        :param urlid: ID of url
+        :return: tuple (number of occurrences, first location) or None if url doesn't contain the word
+        """
+        if wordid in self.shared:
+            hit = self.cached(wordid).get(urlid)
+            return hit[:2] if hit is not None else None
+        row = self.conn.execute(
+            'SELECT count, positions FROM postings WHERE wordid = ? AND urlid = ?', (wordid, urlid)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], indexstore.first_position(row[1])
+
+    def locations(self, wordid, urlid):
+        """
+        Returns sorted array of all locations of the word in url.
+        """
+        if wordid in self.shared:
+            decoded = self.decoded.setdefault(wordid, {})
+            if urlid not in decoded:
+                hit = self.cached(wordid).get(urlid)
+                decoded[urlid] = indexstore.decode_positions(hit[2]) if hit is not None else []
+            return decoded[urlid]
+        row = self.conn.execute(
+            'SELECT positions FROM postings WHERE wordid = ? AND urlid = ?', (wordid, urlid)
+        ).fetchone()
+        return indexstore.decode_positions(row[0]) if row is not None else []
+
+
+def lookup(scores, urlid):
+    """
+    Returns score of url from array indexed by urlid, 0 for url's
+    indexed after the array was built.
+    """
+    if scores is None or urlid >= len(scores):
+        return 0.0
+    return float(scores[urlid])
+
+
+def push_top_k(heap, k, item):
+    """
+    Pushes item to min-heap keeping at most k best items.
+    """
+    if len(heap) < k:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+
+def min_span(location_lists):
+    """
+    Returns length of the smallest window containing at least
+    one location from every list.
+
+    :param location_lists: list of sorted lists of word locations
+    :return: distance between first and last location in window
+    """
+    events = sorted((loc, i) for (i, locations) in enumerate(location_lists) for loc in locations)
+    needed = len(location_lists)
+    counts = [0] * needed
+    covered = 0
+    best = None
+    start = 0
+    for (loc, i) in events:
+        if counts[i] == 0:
+            covered += 1
+        counts[i] += 1
+        while covered == needed:
+            first_loc, j = events[start]
+            if best is None or loc - first_loc < best:
+                best = loc - first_loc
+            counts[j] -= 1
+            if counts[j] == 0:
+                covered -= 1
+            start += 1
+    return best
 
 
 if __name__ == '__main__':
+    import crawler
 
     # krle = crawler.Crawler('bazulja.db')
     # krle.create_index_tables()
@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import OrderedDict
+
+SESSION_TTL = 30 * 60  # Seconds a conversation is remembered after its last message
+MAX_SESSIONS = 10000
+
+
+class TTLCache:
+    """
+    Thread safe in process cache. Entries expire ttl seconds after they
+    were last stored or read, least recently used entries are evicted
+    when the cache is full.
+    """
+    def __init__(self, ttl=SESSION_TTL, max_size=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # {key: (expires, value)} least recently used first
+
+    def get(self, key):
+        """
+        Returns cached value or None if missing or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.entries[key]
+                return None
+            self.entries[key] = (time.time() + self.ttl, entry[1])
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        """
+        Stores value and evicts expired and least recently used entries.
+        """
+        with self.lock:
+            now = time.time()
+            self.entries[key] = (now + self.ttl, value)
+            self.entries.move_to_end(key)
+            # Entries are ordered by last use, so expired ones are at the front
+            while self.entries:
+                oldest = next(iter(self.entries))
+                if self.entries[oldest][0] >= now and len(self.entries) <= self.max_size:
+                    break
+                del self.entries[oldest]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Session:
+    """
+    State of one conversation: last query and its ranked results with
+    the position of the first result not sent yet.
+    """
+    def __init__(self, key, results, cursor=0):
+        self.key = key
+        self.results = results
+        self.cursor = cursor
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs
+    the function, the others wait for and share its result.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # {key: Call} in flight
+
+    def do(self, key, fn):
+        """
+        Runs fn unless a call with the same key is already in flight.
+
+        :param key: hashable key of the call
+        :param fn: function without arguments
+        :return: result of fn
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
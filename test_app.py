@@ -0,0 +1,84 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import crawler
+
+PAGES = [
+    ('http://t.example/shelter', ['shelter', 'open', 'night', 'food']),
+    ('http://t.example/food', ['food', 'bank', 'food']),
+    ('http://t.example/legal', ['legal', 'aid', 'asylum']),
+]
+
+
+class SearchBatchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # App serves searchindex.db and keeps neural net in the working directory
+        cls.cwd = os.getcwd()
+        cls.directory = tempfile.mkdtemp()
+        os.chdir(cls.directory)
+        c = crawler.Crawler('searchindex.db')
+        c.create_index_tables()
+        for (url, words) in PAGES:
+            c.index_page(url, (words, [], '', None))
+        c.dbcommit()
+        del c
+        with mock.patch.dict(os.environ, {'STARTUP_MODE': 'eager'}):
+            import app
+        cls.app = app
+        cls.client = app.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.app.search = None
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {'BATCH_TOKEN': 'secret'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, data, token='secret'):
+        headers = {'Authorization': 'Bearer ' + token} if token is not None else {}
+        return self.client.post('/search/batch', json=data, headers=headers)
+
+    def test_results(self):
+        response = self.post({'queries': ['food', 'legal aid', 'missing'], 'partial': True})
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data)['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0][0]['url'], 'http://t.example/food')
+        self.assertEqual(set(r['url'] for r in results[0]), {'http://t.example/food', 'http://t.example/shelter'})
+        self.assertEqual([r['url'] for r in results[1]], ['http://t.example/legal'])
+        self.assertEqual(results[2], [{'score': -1.0, 'url': 'http://www.unhcr.org/'}])
+
+    def test_token(self):
+        self.assertEqual(self.post({'queries': ['food']}, token=None).status_code, 403)
+        self.assertEqual(self.post({'queries': ['food']}, token='wrong').status_code, 403)
+        self.assertEqual(self.post({'queries': ['food']}, token='sécret').status_code, 403)
+        # Disabled without token configured
+        with mock.patch.dict(os.environ, {'BATCH_TOKEN': ''}):
+            self.assertEqual(self.post({'queries': ['food']}, token='').status_code, 403)
+
+    def test_bad_request(self):
+        self.assertEqual(self.post({}).status_code, 400)
+        self.assertEqual(self.post({'queries': 'food'}).status_code, 400)
+        self.assertEqual(self.post({'queries': ['food', 1]}).status_code, 400)
+        response = self.client.post('/search/batch', data='food', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_too_many_queries(self):
+        self.assertEqual(self.post({'queries': ['food'] * self.app.BATCH_LIMIT}).status_code, 200)
+        self.assertEqual(self.post({'queries': ['food'] * (self.app.BATCH_LIMIT + 1)}).status_code, 413)
+
+    def test_warm_up_failed(self):
+        with mock.patch.object(self.app, 'warm_up_errors', ['no index']):
+            self.assertEqual(self.post({'queries': ['food']}).status_code, 503)
+
+
+if __name__ == '__main__':
+    unittest.main()
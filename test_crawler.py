@@ -0,0 +1,287 @@
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import crawler
+
+SITE = {
+    'http://t.example/': '<a href="/a">a</a><a href="/b">b</a>',
+    'http://t.example/a': '<a href="/d">d</a><a href="/c">c</a>',
+    'http://t.example/b': '<a href="/c">c</a>',
+    'http://t.example/c': '<p>c</p>',
+    'http://t.example/d': '<p>d</p>',
+}
+
+
+class NormalizeUrlTest(unittest.TestCase):
+    def test_same_page(self):
+        forms = [
+            'http://www.example.com/services',
+            'HTTP://WWW.Example.com/services/',
+            'http://www.example.com:80/services',
+            'http://www.example.com/services#top',
+            'http://www.example.com/services?utm_source=fb&fbclid=123',
+            '  http://www.example.com/services  ',
+        ]
+        self.assertEqual(set(crawler.normalize_url(url) for url in forms), {'http://www.example.com/services'})
+
+    def test_root(self):
+        self.assertEqual(crawler.normalize_url('https://example.com'), 'https://example.com/')
+        self.assertEqual(crawler.normalize_url('https://example.com:443/'), 'https://example.com/')
+
+    def test_different_pages(self):
+        self.assertEqual(crawler.normalize_url('http://example.com:8080/a'), 'http://example.com:8080/a')
+        self.assertEqual(crawler.normalize_url('https://example.com:80/a'), 'https://example.com:80/a')
+        self.assertEqual(crawler.normalize_url('http://example.com/A'), 'http://example.com/A')
+        self.assertEqual(
+            crawler.normalize_url('http://example.com/search?q=shelter&utm_medium=x&page=2'),
+            'http://example.com/search?q=shelter&page=2'
+        )
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_no_false_negatives(self):
+        seen = crawler.BloomFilter(1000)
+        urls = ['http://example.com/%d' % i for i in range(1000)]
+        for url in urls:
+            seen.add(url)
+        self.assertTrue(all(url in seen for url in urls))
+
+    def test_false_positive_rate(self):
+        seen = crawler.BloomFilter(5000, error_rate=0.01)
+        for i in range(5000):
+            seen.add('http://example.com/%d' % i)
+        false_positives = sum('http://other.com/%d' % i in seen for i in range(20000))
+        # Expected about 200 at full capacity
+        self.assertLess(false_positives, 400)
+
+    def test_empty(self):
+        self.assertNotIn('http://example.com/', crawler.BloomFilter(10))
+
+
+class AnalyzeTextTest(unittest.TestCase):
+    def test_words_and_sentences(self):
+        text = 'Free legal aid.  Shelters open\nat night!   Ask   for food? '
+        with mock.patch.object(crawler, 'load_summarizer', return_value=None):
+            words, sentences, summary, fingerprint = crawler.analyze_text(text)
+        self.assertEqual(words, ['free', 'legal', 'aid', 'shelter', 'open', 'at', 'night', 'ask', 'for', 'food'])
+        self.assertEqual(
+            sentences, [(0, 'Free legal aid.'), (3, 'Shelters open'), (5, 'at night!'), (7, 'Ask for food?')]
+        )
+        self.assertEqual(summary, 'Free legal aid. Shelters open at night! Ask for food?')
+        self.assertIsNone(fingerprint)
+
+    def test_long_page(self):
+        text = ' '.join('Sentence number %d is about shelter %s.' % (i, 'x' * 300 if i == 3 else '') for i in range(40))
+        with mock.patch.object(crawler, 'load_summarizer', return_value=None):
+            words, sentences, summary, fingerprint = crawler.analyze_text(text)
+        self.assertEqual(len(sentences), 40)
+        self.assertEqual(len(sentences[3][1]), crawler.SNIPPET_LENGTH)
+        self.assertEqual(fingerprint, crawler.simhash(words))
+        self.assertTrue(summary.startswith('Sentence number 0 is about shelter .'))
+
+    def test_summary_leading_sentences(self):
+        sentences = [(i * 20, 'Sentence %d.' % i) for i in range(5)]
+        with mock.patch.object(crawler, 'load_summarizer', return_value=None):
+            # Sentences starting within the first SUMMARY_WORDS words
+            self.assertEqual(crawler.summarize_text('', sentences), 'Sentence 0. Sentence 1. Sentence 2.')
+
+    def test_summary_of_summarizer(self):
+        summarize = mock.Mock(return_value='Shelter is\nopen.  Food too.')
+        with mock.patch.object(crawler, 'load_summarizer', return_value=summarize):
+            self.assertEqual(crawler.summarize_text('text', [(0, 'First.')]), 'Shelter is open. Food too.')
+        summarize.assert_called_once_with('text', word_count=crawler.SUMMARY_WORDS)
+        # Text too short for summarizer
+        summarize = mock.Mock(side_effect=ValueError)
+        with mock.patch.object(crawler, 'load_summarizer', return_value=summarize):
+            self.assertEqual(crawler.summarize_text('text', [(0, 'First.')]), 'First.')
+
+
+def distance(a, b):
+    return bin((a ^ b) & 0xffffffffffffffff).count('1')
+
+
+def change_words(words, rnd, changes):
+    words = list(words)
+    for i in rnd.sample(range(len(words)), changes):
+        words[i] = 'changed%d' % i
+    return words
+
+
+class SimHashTest(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(3)
+        self.vocabulary = ['w%d' % i for i in range(2000)]
+
+    def page(self, length=300):
+        return [self.rnd.choice(self.vocabulary) for i in range(length)]
+
+    def test_few_changed_words(self):
+        distances = []
+        for i in range(40):
+            words = self.page()
+            distances.append(distance(crawler.simhash(words), crawler.simhash(change_words(words, self.rnd, 3))))
+        # 3 of 300 words changed, most pages stay within SIMHASH_DISTANCE
+        self.assertGreaterEqual(sum(d <= crawler.SIMHASH_DISTANCE for d in distances), 30)
+
+    def test_unrelated_pages(self):
+        for i in range(40):
+            self.assertGreater(distance(crawler.simhash(self.page()), crawler.simhash(self.page())), 16)
+
+    def test_near_duplicates_share_band(self):
+        for i in range(1000):
+            fingerprint = self.rnd.getrandbits(64)
+            changed = fingerprint
+            for bit in self.rnd.sample(range(64), self.rnd.randint(0, crawler.SIMHASH_DISTANCE)):
+                changed ^= 1 << bit
+            shared = set(enumerate(crawler.simhash_bands(fingerprint))) & \
+                set(enumerate(crawler.simhash_bands(changed)))
+            self.assertTrue(shared)
+        # Signed value stored in database gives the same bands
+        self.assertEqual(crawler.simhash_bands(crawler.to_signed(fingerprint)), crawler.simhash_bands(fingerprint))
+
+    def test_band_width(self):
+        bands = crawler.simhash_bands(0xffffffffffffffff)
+        self.assertEqual(len(bands), 28)
+        self.assertEqual(set(bands), {0xffff})
+
+
+class DuplicateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.crawler = crawler.Crawler(os.path.join(self.directory, 'index.db'))
+        self.crawler.create_index_tables()
+
+    def tearDown(self):
+        del self.crawler
+        shutil.rmtree(self.directory)
+
+    def index(self, url, words):
+        self.crawler.index_page(url, (words, [], ' '.join(words), crawler.simhash(words)))
+        self.crawler.dbcommit()
+        return self.crawler.get_entry_id('urllist', 'url', url, createnew=False)
+
+    def test_near_duplicate_aliased(self):
+        rnd = random.Random(5)
+        words = ['w%d' % rnd.randint(0, 2000) for i in range(300)]
+        changed = change_words(words, rnd, 1)
+        self.assertLessEqual(distance(crawler.simhash(words), crawler.simhash(changed)), crawler.SIMHASH_DISTANCE)
+        original = self.index('http://t.example/a', words)
+        duplicate = self.index('http://t.example/a?print=1', changed)
+        other = self.index('http://t.example/b', ['w%d' % rnd.randint(0, 2000) for i in range(300)])
+
+        conn = self.crawler.conn
+        self.assertEqual(conn.execute('SELECT urlid, canonicalid FROM urlalias').fetchall(), [(duplicate, original)])
+        postings = dict(conn.execute('SELECT urlid, COUNT(*) FROM postings GROUP BY urlid').fetchall())
+        self.assertNotIn(duplicate, postings)
+        self.assertIn(original, postings)
+        self.assertIn(other, postings)
+        self.assertEqual(
+            set(row[0] for row in conn.execute('SELECT urlid FROM fingerprint')), {original, other}
+        )
+
+    def test_reindexed_page_not_own_duplicate(self):
+        words = ['w%d' % i for i in range(300)]
+        urlid = self.index('http://t.example/a', words)
+        self.assertEqual(self.index('http://t.example/a', change_words(words, random.Random(1), 1)), urlid)
+        self.assertEqual(self.crawler.conn.execute('SELECT COUNT(*) FROM urlalias').fetchone()[0], 0)
+        self.assertEqual(
+            self.crawler.conn.execute('SELECT COUNT(*) FROM simhashband').fetchone()[0], len(crawler.SIMHASH_BANDS)
+        )
+
+    def test_old_bands_rebuilt(self):
+        words = ['w%d' % i for i in range(300)]
+        urlid = self.index('http://t.example/a', words)
+        conn = self.crawler.conn
+        # Index built with 8 bands of 8 bits
+        conn.execute('DELETE FROM simhashband')
+        conn.executemany(
+            'INSERT INTO simhashband(band, value, urlid) VALUES (?, ?, ?)',
+            [(band, crawler.simhash(words) >> (band * 8) & 0xff, urlid) for band in range(8)]
+        )
+        self.crawler.upgrade_index_tables()
+        self.assertEqual(
+            conn.execute('SELECT band, value FROM simhashband ORDER BY band').fetchall(),
+            list(enumerate(crawler.simhash_bands(crawler.simhash(words))))
+        )
+
+
+class FrontierTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.crawler = crawler.Crawler(os.path.join(self.directory, 'index.db'))
+        self.crawler.create_index_tables()
+        self.site = dict(SITE)
+        self.fetched = []
+        self.failing = set()
+
+    def tearDown(self):
+        del self.crawler
+        shutil.rmtree(self.directory)
+
+    def urlopen(self, url):
+        self.fetched.append(url)
+        if url in self.failing:
+            raise IOError(url)
+        return io.BytesIO(self.site[url].encode('utf-8'))
+
+    def crawl(self):
+        with mock.patch.object(crawler, 'FRONTIER_BATCH', 1), \
+                mock.patch.object(crawler.urllib2, 'urlopen', self.urlopen):
+            self.crawler.crawl(['http://t.example/'], depth=3)
+
+    def states(self):
+        return dict(self.crawler.conn.execute('SELECT url, state FROM frontier'))
+
+    def test_linked_pages_first(self):
+        # d is found before c, but c is linked from two pages
+        self.crawl()
+        self.assertEqual(self.fetched[3:], ['http://t.example/c', 'http://t.example/d'])
+        self.assertEqual(set(self.states().values()), {crawler.DONE})
+
+    def test_fetched_as_found(self):
+        # Forms of the same page are fetched once, by the first url found
+        self.site['http://t.example/'] = (
+            '<a href="/e/?x&amp;b=%20y#top">e</a>'
+            '<a href="HTTP://T.EXAMPLE:80/e?x&amp;utm_source=fb&amp;b=%20y">e</a>'
+        )
+        self.site['http://t.example/e/?x&b=%20y'] = '<p>e</p>'
+        self.crawl()
+        self.assertEqual(self.fetched, ['http://t.example/', 'http://t.example/e/?x&b=%20y'])
+        self.assertEqual(self.states(), {'http://t.example/': crawler.DONE, 'http://t.example/e?x=&b=+y': crawler.DONE})
+        urls = [row[0] for row in self.crawler.conn.execute('SELECT url FROM urllist ORDER BY rowid')]
+        self.assertEqual(urls, ['http://t.example/', 'http://t.example/e/?x&b=%20y'])
+        # Seen again in the next crawl by normalized url
+        self.fetched = []
+        self.crawl()
+        self.assertEqual(self.fetched, [])
+
+    def test_old_frontier(self):
+        # Frontier without fetch url column, its pending url's are fetched normalized
+        conn = self.crawler.conn
+        conn.execute('DROP TABLE frontier')
+        conn.execute('CREATE TABLE frontier(url PRIMARY KEY, depth INTEGER, priority INTEGER, state INTEGER)')
+        conn.execute(
+            'INSERT INTO frontier(url, depth, priority, state) VALUES (?, 1, 0, ?)', ('http://t.example/c', crawler.PENDING)
+        )
+        conn.commit()
+        self.crawl()
+        self.assertEqual(self.fetched[:2], ['http://t.example/', 'http://t.example/c'])
+        self.assertEqual(set(self.states().values()), {crawler.DONE})
+
+    def test_failed_pages_retried(self):
+        self.failing.add('http://t.example/d')
+        self.crawl()
+        self.assertEqual(self.states()['http://t.example/d'], crawler.FAILED)
+        self.failing.clear()
+        self.fetched = []
+        self.crawl()
+        self.assertEqual(self.fetched, ['http://t.example/d'])
+        self.assertEqual(self.states()['http://t.example/d'], crawler.DONE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import os
+import shutil
+import sqlite3.dbapi2 as sqlite
+import tempfile
+import unittest
+import crawler
+import indexstore
+
+
+class PositionsCodecTest(unittest.TestCase):
+    def round_trip(self, positions):
+        blob = indexstore.encode_positions(positions)
+        self.assertEqual(list(indexstore.decode_positions(blob)), positions)
+        if positions:
+            self.assertEqual(indexstore.first_position(blob), positions[0])
+        return blob
+
+    def test_empty(self):
+        self.assertEqual(self.round_trip([]), b'')
+
+    def test_single_byte_deltas(self):
+        blob = self.round_trip([0, 1, 5, 127, 254])
+        self.assertEqual(len(blob), 5)
+
+    def test_multi_byte_deltas(self):
+        # Deltas on both sides of every 7 bit boundary take 1 to 5 bytes
+        deltas = [127, 128, 16383, 16384, 2097151, 2097152, 268435455, 268435456, 1]
+        sizes = [1, 2, 2, 3, 3, 4, 4, 5, 1]
+        positions = []
+        for delta in deltas:
+            positions.append((positions[-1] if positions else 0) + delta)
+        blob = self.round_trip(positions)
+        self.assertEqual(len(blob), sum(sizes))
+
+    def test_multi_byte_first_position(self):
+        self.round_trip([300])
+        self.round_trip([100000, 100001])
+
+    def test_mixed_deltas(self):
+        positions = sorted(set((i * 7919) % 1000003 for i in range(2000)))
+        self.round_trip(positions)
+
+
+class SentencesCodecTest(unittest.TestCase):
+    def test_sentence_at(self):
+        sentences = [(0, 'Free legal aid.'), (3, 'Shelters open at night!'), (300, 'Ask for food?')]
+        locations, text = indexstore.encode_sentences(sentences)
+        self.assertEqual(indexstore.sentence_at(locations, text, 0), 'Free legal aid.')
+        self.assertEqual(indexstore.sentence_at(locations, text, 2), 'Free legal aid.')
+        self.assertEqual(indexstore.sentence_at(locations, text, 3), 'Shelters open at night!')
+        self.assertEqual(indexstore.sentence_at(locations, text, 299), 'Shelters open at night!')
+        self.assertEqual(indexstore.sentence_at(locations, text, 1000), 'Ask for food?')
+
+    def test_no_sentences(self):
+        locations, text = indexstore.encode_sentences([])
+        self.assertIsNone(indexstore.sentence_at(locations, text, 0))
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbname = os.path.join(self.directory, 'index.db')
+        conn = sqlite.connect(self.dbname)
+        conn.execute('CREATE TABLE urllist(url)')
+        conn.execute('CREATE TABLE wordlist(word)')
+        conn.execute('CREATE TABLE wordlocation(urlid, wordid, location)')
+        conn.executemany('INSERT INTO urllist(url) VALUES (?)', [('http://a/',), ('http://b/',)])
+        conn.executemany('INSERT INTO wordlist(word) VALUES (?)', [('shelter',), ('food',)])
+        self.locations = {(1, 1): [0, 200, 70000], (1, 2): [1], (2, 1): [5, 6]}
+        conn.executemany(
+            'INSERT INTO wordlocation(urlid, wordid, location) VALUES (?, ?, ?)',
+            [(urlid, wordid, location) for ((wordid, urlid), locations) in self.locations.items()
+             for location in reversed(locations)]
+        )
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def postings(self):
+        conn = sqlite.connect(self.dbname)
+        rows = conn.execute('SELECT wordid, urlid, count, positions FROM postings').fetchall()
+        conn.close()
+        return dict(
+            ((wordid, urlid), (count, list(indexstore.decode_positions(positions))))
+            for (wordid, urlid, count, positions) in rows
+        )
+
+    def test_migrate(self):
+        indexstore.migrate(self.dbname)
+        expected = dict((key, (len(locations), locations)) for (key, locations) in self.locations.items())
+        self.assertEqual(self.postings(), expected)
+
+        conn = sqlite.connect(self.dbname)
+        self.assertFalse(indexstore.has_table(conn, 'wordlocation'))
+        for table in ('pagesentences', 'fingerprint', 'simhashband', 'urlalias'):
+            self.assertTrue(indexstore.has_table(conn, table))
+        self.assertIn('pagetext', [row[1] for row in conn.execute('PRAGMA table_info(urllist)')])
+        conn.close()
+
+    def test_unmigrated_index_rejected(self):
+        with self.assertRaisesRegex(sqlite.OperationalError, 'python indexstore.py'):
+            crawler.Crawler(self.dbname)
+        indexstore.migrate(self.dbname)
+        c = crawler.Crawler(self.dbname)
+        c.index_page('http://c/', (['shelter', 'water'], [(0, 'Shelter water.')], 'Shelter water.', None))
+        c.dbcommit()
+        del c
+        self.assertEqual(self.postings()[(1, 3)], (1, [0]))
+
+    def test_sentences_repacked(self):
+        conn = sqlite.connect(self.dbname)
+        conn.execute('CREATE TABLE pagesentence(urlid INTEGER, location INTEGER, sentence VARCHAR)')
+        conn.executemany(
+            'INSERT INTO pagesentence(urlid, location, sentence) VALUES (?, ?, ?)',
+            [(1, 4, 'Food too.'), (1, 0, 'Shelter is open.'), (2, 0, 'Legal aid.')]
+        )
+        conn.commit()
+        conn.close()
+        indexstore.migrate(self.dbname)
+
+        conn = sqlite.connect(self.dbname)
+        self.assertFalse(indexstore.has_table(conn, 'pagesentence'))
+        pages = dict((row[0], row[1:]) for row in conn.execute('SELECT urlid, locations, sentences FROM pagesentences'))
+        conn.close()
+        self.assertEqual(sorted(pages), [1, 2])
+        self.assertEqual(indexstore.sentence_at(pages[1][0], pages[1][1], 3), 'Shelter is open.')
+        self.assertEqual(indexstore.sentence_at(pages[1][0], pages[1][1], 4), 'Food too.')
+        self.assertEqual(indexstore.sentence_at(pages[2][0], pages[2][1], 9), 'Legal aid.')
+
+    def test_migrate_twice(self):
+        indexstore.migrate(self.dbname)
+        postings = self.postings()
+        indexstore.migrate(self.dbname)
+        self.assertEqual(self.postings(), postings)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import crawler
+import indexstore
+import searchengine
+
+URLS = 300
+WORDS = 40
+QUERIES = ['w1', 'w1 w2', 'w3 w30', 'w1 w5 w25', 'w39 w38', 'w2 w0 w1 w8', 'w0 missing', 'missing']
+
+
+def build_index(dbname, shards=None):
+    """
+    Indexes the same URLS random pages: few common and many rare words, at random locations.
+    """
+    c = crawler.Crawler(dbname, shards)
+    c.create_index_tables()
+    rnd = random.Random(7)
+    for urlid in range(1, URLS + 1):
+        words = ['w%d' % min(int(rnd.expovariate(0.15)), WORDS - 1) for i in range(rnd.randint(5, 80))]
+        c.index_page('http://test/%d' % urlid, (words, [], '', None))
+    c.dbcommit()
+
+
+class TopKTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Searcher keeps its neural net in the working directory
+        cls.cwd = os.getcwd()
+        cls.directory = tempfile.mkdtemp()
+        os.chdir(cls.directory)
+        build_index('index.db')
+        cls.searcher = searchengine.Searcher('index.db')
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.searcher
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.directory)
+
+    def brute_force(self, wordids, partial):
+        # Scores every url with the same signals as top_k, without pruning
+        s = self.searcher
+        reader = searchengine.PostingsReader(s.shard(0))
+        terms = s.term_weights(wordids)
+        if partial:
+            terms = [t for t in terms if t[2] > 0]
+        scores = {}
+        for urlid in range(1, URLS + 1):
+            score = 0.0
+            matched = []
+            for (wordid, weight, df) in terms:
+                hit = reader.probe(wordid, urlid)
+                if hit is not None:
+                    score += s.term_score(weight, hit[0], hit[1])
+                    matched.append(wordid)
+            if not matched or (not partial and len(matched) < len(terms)):
+                continue
+            scores[urlid] = round(score + s.distance_bonus(reader, urlid, wordids, matched), 9)
+        return scores
+
+    def check(self, partial):
+        for q in QUERIES:
+            wordids = self.searcher.get_word_ids(q)
+            if not wordids:
+                continue
+            scores = self.brute_force(wordids, partial)
+            for k in (1, 5, 10):
+                ranked = self.searcher.top_k(wordids, k, partial)
+                # Same best scores, url's with equal scores may be picked in any order
+                self.assertEqual(
+                    [round(score, 9) for (score, urlid, location) in ranked],
+                    sorted(scores.values(), reverse=True)[:k], (q, k)
+                )
+                for (score, urlid, location) in ranked:
+                    self.assertEqual(round(score, 9), scores[urlid], (q, k, urlid))
+
+    def test_conjunctive(self):
+        self.check(partial=False)
+
+    def test_partial(self):
+        self.check(partial=True)
+
+    def test_partial_ranks_incomplete_matches(self):
+        wordids = self.searcher.get_word_ids('w1 w39')
+        complete = self.searcher.top_k(wordids, URLS, partial=False)
+        ranked = self.searcher.top_k(wordids, URLS, partial=True)
+        self.assertGreater(len(ranked), len(complete))
+        self.assertEqual(len(ranked), len(self.brute_force(wordids, partial=True)))
+
+    def test_query_many_matches_query(self):
+        for partial in (False, True):
+            self.assertEqual(
+                self.searcher.query_many(QUERIES + QUERIES, partial),
+                [self.searcher.query(q, partial) for q in QUERIES + QUERIES]
+            )
+
+
+class ShardingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cwd = os.getcwd()
+        cls.directory = tempfile.mkdtemp()
+        os.chdir(cls.directory)
+        build_index('single.db')
+        with mock.patch.object(indexstore, 'SHARDS', 3):
+            build_index('sharded.db')
+        cls.single = searchengine.Searcher('single.db')
+        cls.sharded = searchengine.Searcher('sharded.db')
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.single
+        del cls.sharded
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.directory)
+
+    def test_new_index_sharded(self):
+        self.assertEqual(self.single.shard_names, ['single.db'])
+        self.assertEqual(self.sharded.shard_names, ['sharded.shard%d.db' % i for i in range(3)])
+        for shard in range(3):
+            urlids = [row[0] for row in self.sharded.shard(shard).execute('SELECT DISTINCT urlid FROM postings')]
+            self.assertEqual(len(urlids), URLS // 3)
+            self.assertTrue(all(urlid % 3 == shard for urlid in urlids))
+
+    def scores(self, results):
+        return [[round(score, 9) for (score, url) in result] for result in results]
+
+    def test_same_results(self):
+        # Url's with equal scores may be picked differently, scores must match
+        for partial in (False, True):
+            for q in QUERIES:
+                wordids = self.single.get_word_ids(q)
+                self.assertEqual(
+                    [round(score, 9) for (score, urlid, location) in self.sharded.top_k(wordids, 10, partial)],
+                    [round(score, 9) for (score, urlid, location) in self.single.top_k(wordids, 10, partial)],
+                    (q, partial)
+                )
+            self.assertEqual(
+                self.scores(self.sharded.query_many(QUERIES, partial)),
+                self.scores(self.single.query_many(QUERIES, partial))
+            )
+
+
+class PruningTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cwd = os.getcwd()
+        cls.directory = tempfile.mkdtemp()
+        os.chdir(cls.directory)
+        c = crawler.Crawler('index.db')
+        c.create_index_tables()
+        rnd = random.Random(3)
+        cls.rare_urls = set(rnd.sample(range(1, URLS * 4 + 1), 20))
+        for urlid in range(1, URLS * 4 + 1):
+            # Every page has the common word, few have the rare one
+            words = ['w%d' % rnd.randint(0, WORDS) for i in range(30)]
+            words.insert(rnd.randint(0, 30), 'common')
+            if urlid in cls.rare_urls:
+                words.insert(rnd.randint(0, 30), 'rare')
+            c.index_page('http://test/%d' % urlid, (words, [], '', None))
+        c.dbcommit()
+        del c
+        cls.searcher = searchengine.Searcher('index.db')
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.searcher
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.directory)
+
+    def scanned(self, q, partial):
+        # Number of postings read by top_k
+        count = [0]
+        postings = searchengine.PostingsReader.postings
+
+        def counting(reader, wordid):
+            for posting in postings(reader, wordid):
+                count[0] += 1
+                yield posting
+
+        with mock.patch.object(searchengine.PostingsReader, 'postings', counting):
+            ranked = self.searcher.top_k(self.searcher.get_word_ids(q), 10, partial)
+        self.assertEqual(len(ranked), 10)
+        return count[0]
+
+    def test_common_word_not_scanned(self):
+        rare = len(self.rare_urls)
+        self.assertLessEqual(self.scanned('rare common', partial=False), rare)
+        # Rare word is scanned, the common word only probed (its cursor reads one posting)
+        self.assertLessEqual(self.scanned('rare common', partial=True), rare + 1)
+
+
+PAGES = [
+    ('http://t.example/shelter', 'Shelter is open at night. Hot food is served daily. Legal aid on Mondays.'),
+    ('http://t.example/food', 'Food bank. Free food for families with children.'),
+    ('http://t.example/legal', 'Legal aid for asylum seekers.'),
+]
+
+
+class SnippetTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        c = crawler.Crawler('index.db')
+        c.create_index_tables()
+        with mock.patch.object(crawler, 'load_summarizer', return_value=None):
+            for (url, text) in PAGES:
+                c.index_page(url, crawler.analyze_text(text))
+        c.dbcommit()
+        del c
+        self.searcher = searchengine.Searcher('index.db')
+
+    def tearDown(self):
+        del self.searcher
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_get_pages(self):
+        pages = self.searcher.get_pages([(1.0, 1, 0), (0.5, 1, 6), (0.2, 1, 10), (0.1, 3, 100)])
+        self.assertEqual(pages[3], ('http://t.example/legal', 'Legal aid for asylum seekers.'))
+        # Same url in ranked_scores once per query, last location wins
+        self.assertEqual(pages[1], ('http://t.example/shelter', 'Legal aid on Mondays.'))
+        pages = self.searcher.get_pages([(1.0, 1, 5), (0.5, 2, 3)])
+        self.assertEqual(pages[1], ('http://t.example/shelter', 'Hot food is served daily.'))
+        self.assertEqual(pages[2], ('http://t.example/food', 'Free food for families with children.'))
+
+    def test_query_with_snippets(self):
+        results = self.searcher.query_with_snippets('food')
+        self.assertEqual(
+            sorted((url, snippet) for (score, url, snippet) in results),
+            [('http://t.example/food', 'Food bank.'), ('http://t.example/shelter', 'Hot food is served daily.')]
+        )
+        results = self.searcher.query_with_snippets('legal aid')
+        self.assertEqual(
+            sorted((url, snippet) for (score, url, snippet) in results),
+            [('http://t.example/legal', 'Legal aid for asylum seekers.'),
+             ('http://t.example/shelter', 'Legal aid on Mondays.')]
+        )
+        self.assertEqual(self.searcher.query_with_snippets('missing'), [(-1.0, searchengine.default_page, '')])
+
+    def test_summary_without_sentences(self):
+        self.searcher.conn.execute('DELETE FROM pagesentences WHERE urlid = 1')
+        pages = self.searcher.get_pages([(1.0, 1, 5)])
+        self.assertEqual(pages[1], PAGES[0])
+
+    def test_index_without_sentences(self):
+        # Index crawled before pages were summarized
+        self.searcher.conn.execute('DROP TABLE pagesentences')
+        self.assertEqual(self.searcher.get_pages([(1.0, 2, 0)]), {2: ('http://t.example/food', '')})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import threading
+import time
+import unittest
+import sessions
+
+
+class TTLCacheTest(unittest.TestCase):
+    def test_get_and_put(self):
+        cache = sessions.TTLCache(ttl=60, max_size=10)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('a', 2)
+        self.assertEqual(cache.get('a'), 2)
+        self.assertEqual(len(cache), 1)
+
+    def test_expiry(self):
+        cache = sessions.TTLCache(ttl=0.05, max_size=10)
+        cache.put('a', 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_read_extends_ttl(self):
+        cache = sessions.TTLCache(ttl=0.2, max_size=10)
+        cache.put('a', 1)
+        for i in range(3):
+            time.sleep(0.1)
+            self.assertEqual(cache.get('a'), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = sessions.TTLCache(ttl=60, max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def run_concurrently(self, flight, key, fn, callers):
+        results = [None] * callers
+        errors = [None] * callers
+
+        def call(i):
+            try:
+                results[i] = flight.do(key, fn)
+            except Exception as e:
+                errors[i] = e
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def test_concurrent_calls_run_once(self):
+        flight = sessions.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def search():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return ['result']
+
+        threads, results, errors = self.run_concurrently(flight, 'shelter', search, 20)
+        self.assertTrue(started.wait(5))
+        # Give the other callers time to join the call in flight
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['result']] * 20)
+        self.assertEqual(errors, [None] * 20)
+        self.assertEqual(flight.calls, {})
+
+    def test_error_shared_and_not_kept(self):
+        flight = sessions.SingleFlight()
+        release = threading.Event()
+
+        def fail():
+            release.wait(5)
+            raise ValueError('index unavailable')
+
+        threads, results, errors = self.run_concurrently(flight, 'food', fail, 5)
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertTrue(all(isinstance(e, ValueError) for e in errors))
+        # Failed call is not remembered, the next call runs again
+        self.assertEqual(flight.do('food', lambda: 'ok'), 'ok')
+
+    def test_different_keys_run_separately(self):
+        flight = sessions.SingleFlight()
+        self.assertEqual(flight.do('a', lambda: 1), 1)
+        self.assertEqual(flight.do('b', lambda: 2), 2)
+        self.assertEqual(flight.do('a', lambda: 3), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
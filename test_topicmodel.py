@@ -0,0 +1,87 @@
+import math
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import crawler
+import topicmodel
+
+PAGES = [
+    ('http://t.example/shelter', ['shelter', 'shelter', 'food', 'water']),
+    ('http://t.example/food/water', ['food', 'water', 'water', 'water']),
+    ('http://t.example/legal', ['legal', 'aid', 'legal', 'shelter']),
+    ('http://t.example/empty', ['the', 'of']),
+]
+
+
+class TopicIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbname = os.path.join(self.directory, 'index.db')
+        self.crawler = crawler.Crawler(self.dbname)
+        self.crawler.create_index_tables()
+        for (url, words) in PAGES:
+            self.crawler.index_page(url, (words, [], '', None))
+        self.crawler.dbcommit()
+        self.wordids = dict(self.crawler.conn.execute('SELECT word, rowid FROM wordlist'))
+
+    def tearDown(self):
+        del self.crawler
+        shutil.rmtree(self.directory)
+
+    def build(self):
+        topicmodel.build_topic_index(self.dbname)
+        return topicmodel.load_topic_index(self.dbname)
+
+    def expected_similarities(self, words):
+        # TF-IDF cosine similarity computed directly from PAGES
+        counts = [dict((w, ws.count(w)) for w in ws if w not in crawler.ignorewords) for (url, ws) in PAGES]
+        documents = sum(1 for c in counts if c)
+        idf = dict(
+            (w, math.log((1.0 + documents) / (1.0 + sum(1 for c in counts if w in c))) + 1.0) for w in self.wordids
+        )
+        query = dict((w, idf[w]) for w in words)
+        query_norm = math.sqrt(sum(v * v for v in query.values()))
+        expected = [0.0]  # urlid 0 is never used
+        for c in counts:
+            vector = dict((w, (1.0 + math.log(n)) * idf[w]) for (w, n) in c.items())
+            norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+            expected.append(sum(vector.get(w, 0.0) * query[w] for w in words) / norm / query_norm)
+        return expected
+
+    def test_missing_vectors(self):
+        self.assertIsNone(topicmodel.load_topic_index(self.dbname))
+
+    def test_similarities(self):
+        topics = self.build()
+        for words in (['shelter'], ['food', 'water'], ['legal', 'aid', 'shelter']):
+            similarities = topics.similarities([self.wordids[w] for w in words])
+            self.assertEqual(len(similarities), len(PAGES) + 1)
+            np.testing.assert_allclose(similarities, self.expected_similarities(words), rtol=1e-5, atol=1e-6)
+        self.assertEqual(list(topics.similarities([])), [0.0] * (len(PAGES) + 1))
+
+    def test_urlname_matches(self):
+        topics = self.build()
+        shelter, food, legal = self.wordids['shelter'], self.wordids['food'], self.wordids['legal']
+        self.assertEqual(list(topics.urlname_matches([shelter])), [0.0, 1.0, 0.0, 0.0, 0.0])
+        self.assertEqual(list(topics.urlname_matches([food, legal])), [0.0, 0.0, 0.5, 0.5, 0.0])
+
+    def test_words_newer_than_vectors(self):
+        topics = self.build()
+        self.crawler.index_page('http://t.example/medical', (['medical', 'shelter'], [], '', None))
+        self.crawler.dbcommit()
+        medical = self.crawler.get_entry_id('wordlist', 'word', 'medical', createnew=False)
+        shelter = self.wordids['shelter']
+        self.assertGreaterEqual(medical, topics.vectors.shape[1])
+        self.assertEqual(topics.known([shelter, medical]), [shelter])
+
+        self.assertEqual(list(topics.similarities([medical])), [0.0] * (len(PAGES) + 1))
+        self.assertEqual(list(topics.urlname_matches([medical])), [0.0] * (len(PAGES) + 1))
+        np.testing.assert_allclose(topics.similarities([shelter, medical]), topics.similarities([shelter]))
+        # Unknown word still counts as a query word not found in url name
+        self.assertEqual(list(topics.urlname_matches([shelter, medical])), [0.0, 0.5, 0.0, 0.0, 0.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
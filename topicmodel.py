@@ -0,0 +1,141 @@
+import os
+import re
+import sqlite3.dbapi2 as sqlite
+import numpy as np
+import scipy.sparse as sp
+from nltk.stem import porter
+import indexstore
+
+DB = 'searchindex.db'
+
+splitter = re.compile('\\W+')
+
+
+def vectors_path(dbname):
+    """
+    Returns name of the vectors file kept next to the index database,
+    e.g. searchindex.db -> searchindex.vectors.npz
+
+    :param dbname: name of index database
+    :return: path of vectors file
+    """
+    return os.path.splitext(dbname)[0] + '.vectors.npz'
+
+
+def build_topic_index(dbname=DB, path=None):
+    """
+    Offline stage building TF-IDF vectors of every url and the url name token
+    index from the search index. Both are stored as sparse matrices with one
+    column per word id, so a query only touches columns of its own words.
+
+    :param dbname: name of index database
+    :param path: (default next to database) -> output file
+    """
+    conn = sqlite.connect(dbname)
+    url_count = conn.execute('SELECT MAX(rowid) FROM urllist').fetchone()[0] or 0
+    word_count = conn.execute('SELECT MAX(rowid) FROM wordlist').fetchone()[0] or 0
+    shape = (url_count + 1, word_count + 1)  # Rows and columns are indexed by rowid directly
+
+    rows = []
+    for name in indexstore.shard_names(dbname):
+        shard = sqlite.connect(name)
+        rows.extend(shard.execute(
+            'SELECT urlid, wordid, count FROM postings'
+        ).fetchall())
+        shard.close()
+    counts = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    tf = sp.csr_matrix(
+        (1.0 + np.log(counts[:, 2]), (counts[:, 0].astype(np.int64), counts[:, 1].astype(np.int64))), shape=shape
+    )
+    df = np.bincount(tf.indices, minlength=shape[1])
+    documents = max(np.count_nonzero(np.diff(tf.indptr)), 1)
+    idf = np.log((1.0 + documents) / (1.0 + df)) + 1.0
+
+    # L2 normalized rows, so a dot product with a normalized query is cosine similarity
+    vectors = sp.csr_matrix(tf.multiply(idf))
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    vectors = sp.diags(1.0 / norms).dot(vectors).tocsc().astype(np.float32)
+
+    # Url name tokens that are also indexed words
+    stemmer = porter.PorterStemmer()
+    wordids = dict(conn.execute('SELECT word, rowid FROM wordlist').fetchall())
+    token_rows, token_cols = [], []
+    for (urlid, url) in conn.execute('SELECT rowid, url FROM urllist'):
+        tokens = set(stemmer.stem(s) for s in splitter.split(url.lower()) if s != '')
+        for token in tokens:
+            if token in wordids:
+                token_rows.append(urlid)
+                token_cols.append(wordids[token])
+    url_tokens = sp.csc_matrix(
+        (np.ones(len(token_rows), dtype=np.float32), (token_rows, token_cols)), shape=shape
+    )
+    conn.close()
+
+    np.savez(
+        path or vectors_path(dbname), shape=np.array(shape), idf=idf.astype(np.float32),
+        data=vectors.data, indices=vectors.indices, indptr=vectors.indptr,
+        token_indices=url_tokens.indices, token_indptr=url_tokens.indptr,
+    )
+
+
+def load_topic_index(dbname=DB):
+    """
+    Loads vectors built for the index database.
+
+    :param dbname: name of index database
+    :return: TopicIndex or None if vectors weren't built
+    """
+    path = vectors_path(dbname)
+    if not os.path.exists(path):
+        return None
+    return TopicIndex(path)
+
+
+class TopicIndex:
+    def __init__(self, path):
+        arrays = np.load(path)
+        shape = tuple(arrays['shape'])
+        self.idf = arrays['idf']
+        self.vectors = sp.csc_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape)
+        token_indices = arrays['token_indices']
+        self.url_tokens = sp.csc_matrix(
+            (np.ones(len(token_indices), dtype=np.float32), token_indices, arrays['token_indptr']), shape=shape
+        )
+
+    def known(self, wordids):
+        """
+        Drops word id's added to index after vectors were built.
+        """
+        return [wordid for wordid in wordids if wordid < self.vectors.shape[1]]
+
+    def similarities(self, wordids):
+        """
+        Cosine similarity between the query and every url as one
+        sparse matrix-vector product.
+
+        :param wordids: word id's from query
+        :return: array of similarities indexed by urlid
+        """
+        wordids = self.known(wordids)
+        if not wordids:
+            return np.zeros(self.vectors.shape[0], dtype=np.float32)
+        query = self.idf[wordids]
+        query = query / np.sqrt(np.dot(query, query))
+        return self.vectors[:, wordids].dot(query)
+
+    def urlname_matches(self, wordids):
+        """
+        Share of query words found in every url name.
+
+        :param wordids: word id's from query
+        :return: array of scores between 0 and 1 indexed by urlid
+        """
+        known = self.known(wordids)
+        if not known:
+            return np.zeros(self.url_tokens.shape[0], dtype=np.float32)
+        return np.asarray(self.url_tokens[:, known].sum(axis=1)).ravel() / len(wordids)
+
+
+if __name__ == '__main__':
+    build_topic_index(DB)